@@ -1,11 +1,5 @@
 from random import randrange
 
-import django
-
-
-if django.VERSION < (3, 2):
-    default_app_config = 'django_agent_trust.apps.DefaultConfig'
-
 
 def trust_agent(request, trust_days=None):
     """
@@ -65,8 +59,31 @@ def revoke_other_agents(request):
     :param request: The current request.
     :type request: :class:`~django.http.HttpRequest`
     """
+    from .models import AgentSettings
+
     if request.user.is_authenticated:
-        request.user.agentsettings.serial += 1
-        request.user.agentsettings.save()
+        # request.agent may be lazy; make sure it's loaded with the current
+        # serial before we change it.
+        request.agent.is_trusted
+
+        AgentSettings.objects.ensure_for_user(request.user)
+        request.user.agentsettings.bump_serial()
+
+        # Reissue the cookie with the new serial.
+        request.agent = request.agent._replace(
+            serial=request.user.agentsettings.serial, refreshed_at=None
+        )
+
+
+def revoke_all_agents():
+    """
+    Revoke trust in every agent of every user at once by advancing the global
+    revocation epoch. This requires :setting:`AGENT_EPOCH_CACHE`. Other
+    processes will notice within :setting:`AGENT_EPOCH_TTL` seconds.
+
+    :returns: The new epoch.
+    :rtype: int
+    """
+    from .revocation import revoke_all_agents
 
-        request.agent._serial = request.user.agentsettings.serial
+    return revoke_all_agents()
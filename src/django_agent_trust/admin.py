@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import AgentSettings
+from .models import AgentSettings, RevokedAgent
 
 
 admin.site.register(AgentSettings)
+admin.site.register(RevokedAgent)
@@ -1,4 +1,7 @@
 from django.apps import AppConfig
+from django.core.signals import setting_changed
+
+from . import conf
 
 
 class DefaultConfig(AppConfig):
@@ -7,3 +10,7 @@ class DefaultConfig(AppConfig):
 
     def ready(self):
         from . import signals  # noqa
+
+        # Fail now if the settings are invalid.
+        conf.reload()
+        setting_changed.connect(conf.reload)
@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+
+class AgentSettingsBackendMixin(object):
+    """
+    A mixin for authentication backends that loads each user's
+    :class:`~django_agent_trust.models.AgentSettings` with
+    ``select_related``. :class:`~django_agent_trust.middleware.AgentMiddleware`
+    will use them rather than making its own query, so authenticated requests
+    need one query rather than two.
+
+    This overrides ``get_user``, so it must come before the backend class.
+    """
+
+    def get_user(self, user_id):
+        UserModel = get_user_model()
+
+        try:
+            user = UserModel._default_manager.select_related('agentsettings').get(
+                pk=user_id
+            )
+        except UserModel.DoesNotExist:
+            return None
+
+        return user if self.user_can_authenticate(user) else None
+
+
+class AgentSettingsModelBackend(AgentSettingsBackendMixin, ModelBackend):
+    """
+    :class:`~django.contrib.auth.backends.ModelBackend` with
+    :class:`AgentSettingsBackendMixin`. Use this in place of the default in
+    :setting:`AUTHENTICATION_BACKENDS`.
+    """
+
+    pass
@@ -0,0 +1,221 @@
+"""
+Optional caching of :class:`~django_agent_trust.models.AgentSettings` and of
+verified cookie payloads.
+
+When :setting:`AGENT_SETTINGS_CACHE` names a cache alias, the fields we need on
+every request are stored in that cache so that authenticated requests don't
+have to query the database.
+
+Each user's entry is stored under a key that includes a per-user version,
+which is itself kept in the cache. Readers look up the version before going to
+the database and store what they read under that version. Invalidation
+discards the version, so a reader that loaded a row just before it changed
+writes its stale copy to a key that nobody will read again.
+"""
+
+from collections import OrderedDict
+from secrets import randbits
+from threading import Lock
+
+from django.core.cache import caches
+from django.db import transaction
+
+from . import conf
+
+
+# Bump this if the layout of the cached values changes.
+CACHE_VERSION = 1
+
+FIELD_NAMES = ['id', 'user_id', 'trust_days', 'inactivity_days', 'serial']
+
+
+def get_cache():
+    """
+    Returns the configured cache or ``None`` if caching is disabled.
+    """
+    alias = conf.settings.AGENT_SETTINGS_CACHE
+
+    return caches[alias] if (alias is not None) else None
+
+
+def version_key(user_pk):
+    return 'django_agent_trust:settings-version:{0}'.format(user_pk)
+
+
+def cache_key(user_pk, version):
+    return 'django_agent_trust:settings:{0}@{1}'.format(user_pk, version)
+
+
+def get_agentsettings(model, user, using=None):
+    """
+    Returns a tuple of a cached AgentSettings instance for a user (or
+    ``None``) and the version to pass to :func:`set_agentsettings`.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None, None
+
+    version = _get_version(cache, user.pk)
+    if version is None:
+        return None, None
+
+    values = cache.get(cache_key(user.pk, version), version=CACHE_VERSION)
+    if values is None:
+        return None, version
+
+    return _from_values(model, using, values), version
+
+
+async def aget_agentsettings(model, user, using=None):
+    """
+    Async version of :func:`get_agentsettings`.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None, None
+
+    version = await _aget_version(cache, user.pk)
+    if version is None:
+        return None, None
+
+    values = await cache.aget(cache_key(user.pk, version), version=CACHE_VERSION)
+    if values is None:
+        return None, version
+
+    return _from_values(model, using, values), version
+
+
+def _get_version(cache, user_pk):
+    key = version_key(user_pk)
+
+    version = cache.get(key, version=CACHE_VERSION)
+    if version is None:
+        # A random start keeps us from reusing the versions of lost entries.
+        cache.add(key, _new_version(), timeout=_timeout(), version=CACHE_VERSION)
+        version = cache.get(key, version=CACHE_VERSION)
+
+    return version
+
+
+async def _aget_version(cache, user_pk):
+    key = version_key(user_pk)
+
+    version = await cache.aget(key, version=CACHE_VERSION)
+    if version is None:
+        await cache.aadd(key, _new_version(), timeout=_timeout(), version=CACHE_VERSION)
+        version = await cache.aget(key, version=CACHE_VERSION)
+
+    return version
+
+
+def _new_version():
+    return randbits(32)
+
+
+def _timeout():
+    return conf.settings.AGENT_SETTINGS_CACHE_TIMEOUT
+
+
+def _from_values(model, using, values):
+    if values[0] is not None:
+        agentsettings = model.from_db(using, FIELD_NAMES, values)
+    else:
+        # An unsaved default (see AGENT_SETTINGS_SPARSE).
+        agentsettings = model(**dict(zip(FIELD_NAMES, values)))
+
+    return agentsettings
+
+
+def set_agentsettings(agentsettings, version):
+    """
+    Stores an AgentSettings instance in the cache under the version returned
+    by :func:`get_agentsettings`. Unsaved defaults are cached too, so that
+    users without rows don't have to be looked up again.
+    """
+    cache = get_cache()
+    if (cache is not None) and (version is not None):
+        cache.set(
+            cache_key(agentsettings.user_id, version),
+            [getattr(agentsettings, name) for name in FIELD_NAMES],
+            timeout=_timeout(),
+            version=CACHE_VERSION,
+        )
+
+
+async def aset_agentsettings(agentsettings, version):
+    """
+    Async version of :func:`set_agentsettings`.
+    """
+    cache = get_cache()
+    if (cache is not None) and (version is not None):
+        await cache.aset(
+            cache_key(agentsettings.user_id, version),
+            [getattr(agentsettings, name) for name in FIELD_NAMES],
+            timeout=_timeout(),
+            version=CACHE_VERSION,
+        )
+
+
+def invalidate(user_pk):
+    """
+    Discards any cached settings for a user by discarding the user's version.
+
+    This happens immediately and again when the current transaction commits,
+    so that readers that see the old row before the commit store it under a
+    version that has already been abandoned.
+    """
+    cache = get_cache()
+    if cache is not None:
+        key = version_key(user_pk)
+
+        cache.delete(key, version=CACHE_VERSION)
+        transaction.on_commit(lambda: cache.delete(key, version=CACHE_VERSION))
+
+
+def invalidate_many(user_pks):
+    """
+    Discards any cached settings for many users. See :func:`invalidate`.
+    """
+    cache = get_cache()
+    if cache is not None:
+        keys = [version_key(pk) for pk in user_pks]
+
+        cache.delete_many(keys, version=CACHE_VERSION)
+        transaction.on_commit(lambda: cache.delete_many(keys, version=CACHE_VERSION))
+
+
+class LRUCache(object):
+    """
+    A small, thread-safe, process-local LRU mapping.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        Returns the value for ``key``, or ``None`` if it's not cached.
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,156 @@
+"""
+Compact binary encoding for agent cookies.
+
+The payload is a fixed binary layout whose first byte is a format version,
+encoded with URL-safe base64. The legacy encoding is base64-encoded JSON, which
+always starts with ``'e'`` (from ``'{'``). Versions below 0x78 can never
+produce that character, so the two are easy to tell apart.
+
+Changes to the layout must add a new version, keeping the old layouts so that
+existing cookies can still be decoded. Unknown versions decode to an empty
+payload.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import sha256
+import struct
+
+
+VERSION = 1
+
+# Maps each version to its layout and field names.
+_LAYOUTS = {
+    1: (
+        struct.Struct('!BBIdiII8sIQII'),
+        [
+            'version',
+            'flags',
+            'trusted_at',
+            'trust_days',
+            'serial',
+            'session',
+            'refreshed_at',
+            'username_digest',
+            'epoch',
+            'agent_id',
+            'expires',
+            'stamp',
+        ],
+    ),
+}
+
+_TRUSTED = 0x01
+_HAS_TRUSTED_AT = 0x02
+_HAS_TRUST_DAYS = 0x04
+_HAS_SESSION = 0x08
+_HAS_REFRESHED_AT = 0x10
+_HAS_AGENT_ID = 0x20
+_HAS_EXPIRES = 0x40
+_HAS_STAMP = 0x80
+
+
+def is_compact(encoded):
+    return not encoded.startswith('e')
+
+
+def username_digest(username):
+    return sha256(username.encode('utf-8')).digest()[:8]
+
+
+def can_encode(data):
+    """
+    True if a jsonable agent can be represented in the compact encoding.
+    Session tokens, epochs, expirations and stamps must be 32-bit unsigned
+    integers and agent IDs 64-bit unsigned integers.
+    """
+    checks = [
+        _is_uint(data.get('epoch', 0), 32),
+        _is_optional_uint(data.get('session'), 32),
+        _is_optional_uint(data.get('agent_id'), 64),
+        _is_optional_uint(data.get('expires'), 32),
+        _is_optional_uint(data.get('stamp'), 32),
+    ]
+
+    return all(checks)
+
+
+def _is_uint(value, bits):
+    return isinstance(value, int) and (0 <= value < 2**bits)
+
+
+def _is_optional_uint(value, bits):
+    return (value is None) or _is_uint(value, bits)
+
+
+def encode(data):
+    """
+    Encodes the output of :meth:`~django_agent_trust.models.Agent.to_jsonable`.
+    """
+    flags = 0
+    if data['is_trusted']:
+        flags |= _TRUSTED
+    if data['trusted_at'] is not None:
+        flags |= _HAS_TRUSTED_AT
+    if data['trust_days'] is not None:
+        flags |= _HAS_TRUST_DAYS
+    if data['session'] is not None:
+        flags |= _HAS_SESSION
+    if data.get('refreshed_at') is not None:
+        flags |= _HAS_REFRESHED_AT
+    if data.get('agent_id') is not None:
+        flags |= _HAS_AGENT_ID
+    if data.get('expires') is not None:
+        flags |= _HAS_EXPIRES
+    if data.get('stamp') is not None:
+        flags |= _HAS_STAMP
+
+    layout, _ = _LAYOUTS[VERSION]
+    packed = layout.pack(
+        VERSION,
+        flags,
+        data['trusted_at'] or 0,
+        data['trust_days'] or 0.0,
+        data['serial'],
+        data['session'] or 0,
+        data.get('refreshed_at') or 0,
+        username_digest(data['username']),
+        data.get('epoch', 0),
+        data.get('agent_id') or 0,
+        data.get('expires') or 0,
+        data.get('stamp') or 0,
+    )
+
+    return urlsafe_b64encode(packed).rstrip(b'=').decode('ascii')
+
+
+def decode(encoded):
+    """
+    Decodes a compact payload into a jsonable dict. The plaintext username is
+    replaced by ``'username_digest'``. Unrecognized payloads decode to an empty
+    dict.
+    """
+    packed = urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+
+    version = packed[0] if packed else None
+    layout, names = _LAYOUTS.get(version, (None, None))
+    if (layout is None) or (len(packed) != layout.size):
+        return {}
+
+    fields = dict(zip(names, layout.unpack(packed)))
+    flags = fields['flags']
+
+    return {
+        'username_digest': fields['username_digest'],
+        'is_trusted': bool(flags & _TRUSTED),
+        'trusted_at': fields['trusted_at'] if (flags & _HAS_TRUSTED_AT) else None,
+        'trust_days': fields['trust_days'] if (flags & _HAS_TRUST_DAYS) else None,
+        'serial': fields['serial'],
+        'session': fields['session'] if (flags & _HAS_SESSION) else None,
+        'refreshed_at': (
+            fields['refreshed_at'] if (flags & _HAS_REFRESHED_AT) else None
+        ),
+        'epoch': fields['epoch'],
+        'agent_id': fields['agent_id'] if (flags & _HAS_AGENT_ID) else None,
+        'expires': fields['expires'] if (flags & _HAS_EXPIRES) else None,
+        'stamp': fields['stamp'] if (flags & _HAS_STAMP) else None,
+    }
@@ -1,53 +1,231 @@
+from numbers import Number
+import re
+from types import MappingProxyType
+
 import django.conf
+from django.core.exceptions import ImproperlyConfigured
 
 
 class Settings(object):
     """
-    This is a simple class to take the place of the global settings object. An
-    instance will contain all of our settings as attributes, with default values
-    if they are not specified by the configuration.
+    An immutable snapshot of our settings, taking the place of the global
+    settings object. An instance contains all of our settings as attributes,
+    with default values if they are not specified by the configuration, along
+    with some values derived from them.
+
+    The current snapshot is always ``conf.settings``. It's validated and
+    replaced whenever the Django settings change, so callers should look it up
+    through the module rather than importing it directly.
     """
 
     defaults = {
+        'AGENT_COOKIE_CACHE_SIZE': 0,
         'AGENT_COOKIE_DOMAIN': None,
+        'AGENT_COOKIE_FORMAT': 'json',
         'AGENT_COOKIE_HTTPONLY': True,
+        'AGENT_COOKIE_MAX_USERS': 5,
+        'AGENT_COOKIE_MODE': 'per-user',
         'AGENT_COOKIE_NAME': 'agent-trust',
         'AGENT_COOKIE_PATH': '/',
+        'AGENT_COOKIE_REFRESH_FRACTION': None,
         'AGENT_COOKIE_SECURE': False,
-        'AGENT_LOGIN_URL': django.conf.settings.LOGIN_URL,
+        'AGENT_DENYLIST_TTL': 5,
+        'AGENT_EPOCH_CACHE': None,
+        'AGENT_EPOCH_TTL': 5,
+        'AGENT_EXEMPT_PATHS': [],
+        'AGENT_LOG_SAMPLE_RATE': 1.0,
+        'AGENT_LOGIN_URL': None,  # Defaults to LOGIN_URL.
         'AGENT_TRUST_DAYS': None,
+        'AGENT_TRUST_EPOCH': 0,
         'AGENT_INACTIVITY_DAYS': 365,
+        'AGENT_SETTINGS_CACHE': None,
+        'AGENT_SETTINGS_CACHE_TIMEOUT': 3600,
+        'AGENT_SETTINGS_SPARSE': False,
+        'AGENT_SERVER_TIMING': False,
+        'AGENT_STATS_CALLBACK': None,
+        'AGENT_TIMING': False,
     }
 
-    def __init__(self):
+    __slots__ = tuple(defaults) + (
+        # The global inactivity limit in seconds.
+        'max_cookie_age',
+        # Keyword arguments for HttpResponse.set_cookie().
+        'cookie_kwargs',
+        # Keyword arguments for HttpResponse.delete_cookie().
+        'delete_cookie_kwargs',
+        # Compiled AGENT_EXEMPT_PATHS.
+        'exempt_paths',
+    )
+
+    def __init__(self, **values):
+        """
+        Builds a snapshot from a complete set of values. Use :meth:`load` to
+        read them from django.conf.settings.
+        """
+        for name in self.defaults:
+            object.__setattr__(self, name, values[name])
+
+        self._validate()
+
+        derived = {
+            'max_cookie_age': self.AGENT_INACTIVITY_DAYS * 86400,
+            'cookie_kwargs': MappingProxyType(
+                {
+                    'path': self.AGENT_COOKIE_PATH,
+                    'domain': self.AGENT_COOKIE_DOMAIN,
+                    'secure': self.AGENT_COOKIE_SECURE,
+                    'httponly': self.AGENT_COOKIE_HTTPONLY,
+                }
+            ),
+            'delete_cookie_kwargs': MappingProxyType(
+                {
+                    'path': self.AGENT_COOKIE_PATH,
+                    'domain': self.AGENT_COOKIE_DOMAIN,
+                }
+            ),
+            'exempt_paths': tuple(re.compile(r) for r in self.AGENT_EXEMPT_PATHS),
+        }
+        for name, value in derived.items():
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def load(cls):
         """
         Loads our settings from django.conf.settings, applying defaults for any
         that are omitted.
         """
-        for name, default in self.defaults.items():
-            value = getattr(django.conf.settings, name, default)
-            setattr(self, name, value)
+        defaults = dict(cls.defaults, AGENT_LOGIN_URL=django.conf.settings.LOGIN_URL)
+        values = {
+            name: getattr(django.conf.settings, name, default)
+            for name, default in defaults.items()
+        }
+
+        return cls(**values)
+
+    def replace(self, **kwargs):
+        """
+        Returns a new snapshot with some settings replaced.
+        """
+        values = {name: getattr(self, name) for name in self.defaults}
+        values.update(kwargs)
+
+        return type(self)(**values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Settings are immutable.")
+
+    def _validate(self):
+        def check(condition, message):
+            if not condition:
+                raise ImproperlyConfigured(message)
+
+        check(
+            _is_number(self.AGENT_INACTIVITY_DAYS),
+            "AGENT_INACTIVITY_DAYS must be a number.",
+        )
+        check(
+            (self.AGENT_TRUST_DAYS is None) or _is_number(self.AGENT_TRUST_DAYS),
+            "AGENT_TRUST_DAYS must be a number or None.",
+        )
+        check(
+            self.AGENT_COOKIE_FORMAT in ['json', 'compact'],
+            "AGENT_COOKIE_FORMAT must be 'json' or 'compact'.",
+        )
+        check(
+            self.AGENT_COOKIE_MODE in ['per-user', 'consolidated'],
+            "AGENT_COOKIE_MODE must be 'per-user' or 'consolidated'.",
+        )
+        check(
+            _is_int(self.AGENT_COOKIE_MAX_USERS, 1),
+            "AGENT_COOKIE_MAX_USERS must be a positive integer.",
+        )
+        check(
+            _is_int(self.AGENT_COOKIE_CACHE_SIZE, 0),
+            "AGENT_COOKIE_CACHE_SIZE must be a non-negative integer.",
+        )
+        check(
+            _is_fraction(self.AGENT_COOKIE_REFRESH_FRACTION),
+            "AGENT_COOKIE_REFRESH_FRACTION must be None or a number from 0 to 1.",
+        )
+        check(
+            _is_probability(self.AGENT_LOG_SAMPLE_RATE),
+            "AGENT_LOG_SAMPLE_RATE must be a number from 0 to 1.",
+        )
+        check(
+            _is_callback(self.AGENT_STATS_CALLBACK),
+            "AGENT_STATS_CALLBACK must be None, a callable, or a dotted path.",
+        )
+        check(
+            _is_int(self.AGENT_TRUST_EPOCH, 0),
+            "AGENT_TRUST_EPOCH must be a non-negative integer.",
+        )
+
+        for pattern in self.AGENT_EXEMPT_PATHS:
+            try:
+                re.compile(pattern)
+            except (re.error, TypeError) as e:
+                raise ImproperlyConfigured(
+                    "Invalid AGENT_EXEMPT_PATHS pattern {0!r}: {1}".format(pattern, e)
+                )
 
     #
     # Inspired by django.test.TestCase.settings, objects of this class can be
     # used as a context managager to temporarily override settings.
     #
     class ContextManager(object):
-        def __init__(self, settings, contextual):
-            self.settings = settings
-            self.original = dict((k, getattr(settings, k)) for k in contextual)
+        def __init__(self, contextual):
             self.contextual = contextual
 
         def __enter__(self):
-            for k, v in self.contextual.items():
-                setattr(self.settings, k, v)
+            global settings
+
+            self.original = settings
+            settings = settings.replace(**self.contextual)
 
         def __exit__(self, *args, **kwargs):
-            for k, v in self.original.items():
-                setattr(self.settings, k, v)
+            global settings
+
+            settings = self.original
 
     def __call__(self, **kwargs):
-        return self.ContextManager(self, kwargs)
+        return self.ContextManager(kwargs)
+
+
+def _is_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def _is_int(value, minimum):
+    return (
+        isinstance(value, int) and (not isinstance(value, bool)) and (value >= minimum)
+    )
+
+
+def _is_probability(value):
+    return _is_number(value) and (0 <= value <= 1)
+
+
+def _is_fraction(value):
+    return (value is None) or _is_probability(value)
+
+
+def _is_callback(value):
+    return (value is None) or isinstance(value, str) or callable(value)
+
+
+def reload(**kwargs):
+    """
+    Rebuilds :data:`settings` from django.conf.settings. This is connected to
+    :data:`~django.test.signals.setting_changed`.
+    """
+    global settings
+
+    setting = kwargs.get('setting')
+    if (setting is None) or setting.startswith('AGENT_') or (setting == 'LOGIN_URL'):
+        settings = Settings.load()
 
 
-settings = Settings()
+settings = Settings.load()
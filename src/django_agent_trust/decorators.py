@@ -1,8 +1,12 @@
 from functools import wraps
+from urllib.parse import urlsplit
 
-from django.contrib.auth.decorators import user_passes_test
+from asgiref.sync import iscoroutinefunction
 
-from .conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.shortcuts import resolve_url
+
+from . import conf
 
 
 def trusted_agent_required(view=None, redirect_field_name='next', login_url=None):
@@ -10,24 +14,112 @@ def trusted_agent_required(view=None, redirect_field_name='next', login_url=None
     Similar to :func:`~django.contrib.auth.decorators.login_required`, but
     requires ``request.agent.is_trusted`` to be true. This will frequently be
     used in conjunction with login_required, unless you're allowing trusted
-    agents to bypass authentication.
+    agents to bypass authentication. Both sync and async views are supported.
 
     The default value for ``login_url`` is :setting:`AGENT_LOGIN_URL`.
     """
-    if login_url is None:
-        login_url = settings.AGENT_LOGIN_URL
 
     def decorator(view_func):
-        @wraps(view_func)
-        def _wrapped_view(request, *args, **kwargs):
-            enforcer = user_passes_test(
-                lambda u: request.agent.is_trusted,
-                redirect_field_name=redirect_field_name,
-                login_url=login_url,
-            )
+        if iscoroutinefunction(view_func):
+
+            async def _view_wrapper(request, *args, **kwargs):
+                if request.agent.is_trusted:
+                    return await view_func(request, *args, **kwargs)
+
+                return redirect_to_agent_login(request, login_url, redirect_field_name)
+
+        else:
+
+            def _view_wrapper(request, *args, **kwargs):
+                if request.agent.is_trusted:
+                    return view_func(request, *args, **kwargs)
 
-            return enforcer(view_func)(request, *args, **kwargs)
+                return redirect_to_agent_login(request, login_url, redirect_field_name)
 
-        return _wrapped_view
+        return wraps(view_func)(_view_wrapper)
 
     return decorator(view) if (view is not None) else decorator
+
+
+class TrustedAgentRequiredMixin(object):
+    """
+    A class-based view mixin that applies :func:`trusted_agent_required` to all
+    requests. This should come before the view class in the list of bases.
+    Sync and async views are both supported.
+
+    .. attribute:: agent_login_url
+
+        The login URL. Defaults to :setting:`AGENT_LOGIN_URL`.
+
+    .. attribute:: redirect_field_name
+
+        The name of the query parameter that holds the requested URL. Defaults
+        to ``'next'``.
+    """
+
+    agent_login_url = None
+    redirect_field_name = 'next'
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.agent.is_trusted:
+            return super().dispatch(request, *args, **kwargs)
+
+        response = redirect_to_agent_login(
+            request, self.agent_login_url, self.redirect_field_name
+        )
+
+        if getattr(self, 'view_is_async', False):
+
+            async def func():
+                return response
+
+            return func()
+
+        return response
+
+
+def redirect_to_agent_login(request, login_url=None, redirect_field_name='next'):
+    """
+    Redirects to the login URL, with the current URL as the redirect target.
+    This is what :func:`~django.contrib.auth.decorators.user_passes_test`
+    does for failed tests.
+    """
+    path = request.build_absolute_uri()
+    resolved_login_url = resolve_url(login_url or conf.settings.AGENT_LOGIN_URL)
+
+    # If the login url is the same scheme and net location then just use the
+    # path as the "next" url.
+    login_scheme, login_netloc = urlsplit(resolved_login_url)[:2]
+    current_scheme, current_netloc = urlsplit(path)[:2]
+    if (not login_scheme or login_scheme == current_scheme) and (
+        not login_netloc or login_netloc == current_netloc
+    ):
+        path = request.get_full_path()
+
+    return redirect_to_login(path, resolved_login_url, redirect_field_name)
+
+
+def agent_trust_exempt(view_func):
+    """
+    Marks a view as exempt from
+    :class:`~django_agent_trust.middleware.AgentMiddleware`. The middleware
+    won't load the agent or touch its cookie, and ``request.agent`` will be a
+    shared untrusted agent. This is intended for busy endpoints that have no
+    use for agent trust. As with
+    :func:`~django.views.decorators.csrf.csrf_exempt`, class-based views must
+    decorate ``dispatch``.
+    """
+    if iscoroutinefunction(view_func):
+
+        async def _view_wrapper(request, *args, **kwargs):
+            return await view_func(request, *args, **kwargs)
+
+    else:
+
+        def _view_wrapper(request, *args, **kwargs):
+            return view_func(request, *args, **kwargs)
+
+    _view_wrapper = wraps(view_func)(_view_wrapper)
+    _view_wrapper.agent_trust_exempt = True
+
+    return _view_wrapper
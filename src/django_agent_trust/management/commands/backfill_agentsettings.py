@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from django_agent_trust.models import AgentSettings
+
+
+class Command(BaseCommand):
+    help = "Creates default AgentSettings for all users that don't have them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help="Rows to insert per batch (default 1000).",
+        )
+
+    def handle(self, *args, **options):
+        def progress(count, last_pk):
+            if options['verbosity'] > 0:
+                self.stdout.write(
+                    "Created AgentSettings for {0} users (last pk: {1})".format(
+                        count, last_pk
+                    )
+                )
+
+        count = AgentSettings.objects.backfill(
+            batch_size=options['batch_size'], progress=progress
+        )
+
+        if options['verbosity'] > 0:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    "Done. Created AgentSettings for {0} users.".format(count)
+                )
+            )
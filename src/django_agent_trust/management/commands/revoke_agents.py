@@ -0,0 +1,112 @@
+from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from django_agent_trust import revoke_all_agents
+from django_agent_trust.models import AgentSettings
+
+
+class Command(BaseCommand):
+    help = (
+        "Revokes all trusted agents for the selected users by incrementing their "
+        "AgentSettings serials in batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', help="Revoke trusted agents for all users."
+        )
+        parser.add_argument(
+            '--epoch',
+            action='store_true',
+            help=(
+                "Revoke trusted agents for all users at once by advancing the "
+                "global revocation epoch. Requires AGENT_EPOCH_CACHE."
+            ),
+        )
+        parser.add_argument(
+            '--user',
+            action='append',
+            default=[],
+            dest='usernames',
+            metavar='USERNAME',
+            help="Revoke trusted agents for this user. May be repeated.",
+        )
+        parser.add_argument(
+            '--filter',
+            action='append',
+            default=[],
+            dest='filters',
+            metavar='LOOKUP=VALUE',
+            help="Select users with a queryset lookup, e.g. is_staff=True. May be repeated.",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help="Users per batch (default 1000).",
+        )
+        parser.add_argument(
+            '--start-after',
+            metavar='PK',
+            help="Skip users up to and including this primary key, to resume a previous run.",
+        )
+
+    def handle(self, *args, **options):
+        if options['epoch']:
+            return self._advance_epoch(options)
+
+        users = self._select_users(options)
+
+        def progress(count, last_pk):
+            if options['verbosity'] > 0:
+                self.stdout.write(
+                    "Revoked agents for {0} users (last pk: {1})".format(count, last_pk)
+                )
+
+        count = AgentSettings.objects.bump_serials(
+            users,
+            batch_size=options['batch_size'],
+            start_after=options['start_after'],
+            progress=progress,
+        )
+
+        if options['verbosity'] > 0:
+            self.stdout.write(
+                self.style.SUCCESS("Done. Revoked agents for {0} users.".format(count))
+            )
+
+    def _advance_epoch(self, options):
+        if options['all'] or options['usernames'] or options['filters']:
+            raise CommandError("--epoch can't be combined with other selections.")
+
+        try:
+            epoch = revoke_all_agents()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        if options['verbosity'] > 0:
+            self.stdout.write(
+                self.style.SUCCESS("Done. Advanced to epoch {0}.".format(epoch))
+            )
+
+    def _select_users(self, options):
+        User = get_user_model()
+        users = User._default_manager.all()
+
+        if options['usernames']:
+            users = users.filter(
+                **{'{0}__in'.format(User.USERNAME_FIELD): options['usernames']}
+            )
+
+        for lookup in options['filters']:
+            try:
+                key, value = lookup.split('=', 1)
+                users = users.filter(**{key: value})
+            except (ValueError, FieldError) as e:
+                raise CommandError("Invalid filter {0}: {1}".format(lookup, e))
+
+        if not (options['all'] or options['usernames'] or options['filters']):
+            raise CommandError("Select users with --user or --filter, or pass --all.")
+
+        return users
@@ -4,16 +4,80 @@ import enum
 from hashlib import md5
 import json
 import logging
+from random import random
+from time import time
 
-from django.core.exceptions import ImproperlyConfigured
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
 from django.http import HttpRequest, HttpResponse
+from django.utils.functional import SimpleLazyObject, empty
 
-from .conf import settings
+from . import codec, conf, stats, timing
+from .cache import LRUCache
 from .models import SESSION_TOKEN_KEY, Agent, AgentSettings
+from .revocation import acurrent_epoch, current_epoch, denylist
+from .signals import agent_timing
 
 
 logger = logging.getLogger(__name__)
 
+# Separators for entries in the consolidated cookie. Both are legal in cookie
+# values and never appear in signed values.
+ENTRY_SEP = '|'
+SUFFIX_SEP = '!'
+
+# Shared by all exempt requests, which are recognized by identity. This must not
+# be the shared agent of anonymous requests, whose cookies we still manage.
+EXEMPT_AGENT = Agent(AnonymousUser(), False, None, None, -1, None)
+
+
+class _LogFields(dict):
+    """
+    The structured fields of a log record, rendered as ``key=value`` pairs
+    only if the record is emitted.
+    """
+
+    def __str__(self):
+        return ' '.join('{0}={1}'.format(key, value) for key, value in self.items())
+
+
+def _should_log():
+    """
+    True if a debug record should be emitted (see
+    :setting:`AGENT_LOG_SAMPLE_RATE`). Call this before computing any fields.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+
+    rate = conf.settings.AGENT_LOG_SAMPLE_RATE
+
+    return (rate >= 1) or (random() < rate)
+
+
+def _log_agent(event, username, agent, reason=None):
+    """
+    Emits a debug record for an agent. The fields are also attached to the
+    record as ``agent_trust``.
+    """
+    if reason is not None:
+        outcome = 'discarded'
+    elif agent.is_trusted:
+        outcome = 'trusted'
+    else:
+        outcome = 'untrusted'
+
+    fields = _LogFields(
+        event=event,
+        username_hash=codec.username_digest(username).hex(),
+        serial=agent.serial if agent.is_trusted else None,
+        outcome=outcome,
+        reason=reason,
+    )
+
+    logger.debug('Agent %s', fields, extra={'agent_trust': fields})
+
 
 class CookieAction(enum.Enum):
     """
@@ -36,39 +100,102 @@ class AgentMiddleware(object):
 
     This middleware will set ``request.agent`` to an instance of
     :class:`django_agent_trust.models.Agent`. ``request.agent.is_trusted`` will
-    tell you whether the user's agent has been trusted.
+    tell you whether the user's agent has been trusted. The agent is loaded
+    lazily, so requests that never look at ``request.agent`` don't pay for
+    verifying the cookie, nor do they update it.
+
+    This middleware supports both sync and async requests. When running
+    asynchronously, the agent is loaded just before an async view is called
+    using the async ORM, so that the view can safely access it. Sync views run
+    in a thread and load the agent lazily, as usual.
+
+    Requests matching :setting:`AGENT_EXEMPT_PATHS` and views decorated with
+    :func:`~django_agent_trust.decorators.agent_trust_exempt` are skipped
+    entirely: ``request.agent`` will be a shared untrusted agent for an
+    anonymous user and the cookie will not be touched.
 
     This can be subclassed to override documented methods.
 
     """
 
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response=None):
         self.get_response = get_response
 
-    def __call__(self, request):
-        if request.user.is_authenticated:
-            AgentSettings.objects.ensure_for_user(request.user)
-            request.agent = self._load_agent(request)
+        if conf.settings.AGENT_COOKIE_CACHE_SIZE > 0:
+            #: A process-local cache of verified cookie payloads.
+            self.payload_cache = LRUCache(conf.settings.AGENT_COOKIE_CACHE_SIZE)
         else:
-            request.agent = Agent.untrusted_agent(request.user)
+            self.payload_cache = None
 
-        response = self.get_response(request)
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # Keep Django from running process_view in a thread.
+            self.process_view = self._aprocess_view
 
-        agent = getattr(request, 'agent', None)
-        if agent:
-            action = self.cookie_action(request, response, agent)
-            if action is CookieAction.SAVE:
-                self._save_agent(agent, response)
-            elif action is CookieAction.CLEAR:
-                self._clear_agent(agent, response)
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        timer = self._start_timing()
+        try:
+            self._process_request(request)
+
+            response = self.get_response(request)
+
+            self._process_response(request, response)
+        finally:
+            if timer is not None:
+                timing.stop(timer[1])
+
+        if timer is not None:
+            self._report_timing(request, response, timer[0])
+
+        return response
+
+    async def __acall__(self, request):
+        timer = self._start_timing()
+        try:
+            self._process_request(request)
+
+            response = await self.get_response(request)
+
+            self._process_response(request, response)
+        finally:
+            if timer is not None:
+                timing.stop(timer[1])
+
+        if timer is not None:
+            self._report_timing(request, response, timer[0])
 
         return response
 
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, 'agent_trust_exempt', False):
+            request.agent = EXEMPT_AGENT
+        elif iscoroutinefunction(view_func) and self._is_pending(request):
+            # An async view can't load the agent lazily, so we load it while
+            # we're still in a sync context.
+            request.agent = self._get_agent(request)
+
+    async def _aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, 'agent_trust_exempt', False):
+            request.agent = EXEMPT_AGENT
+        elif iscoroutinefunction(view_func) and self._is_pending(request):
+            # Sync views run in a thread, where the lazy agent can load itself.
+            request.agent = await self._aget_agent(request)
+
     def cookie_action(
         self, request: HttpRequest, response: HttpResponse, agent: Agent
     ) -> CookieAction:
         """
-        Decides how to handle the cookie in the response.
+        Decides how to handle the cookie in the response. By default, we save
+        the cookie for trusted agents (subject to
+        :setting:`AGENT_COOKIE_REFRESH_FRACTION`) and delete it for untrusted
+        agents if the request included one.
 
         This can be overridden to implement custom policies.
 
@@ -76,107 +203,522 @@ class AgentMiddleware(object):
         if agent.user.is_anonymous:
             action = CookieAction.NONE
         elif agent.is_trusted:
-            action = CookieAction.SAVE
-        else:
+            if self._needs_refresh(agent):
+                action = CookieAction.SAVE
+            else:
+                action = CookieAction.NONE
+        elif self._has_cookie(request, agent.username):
             action = CookieAction.CLEAR
+        else:
+            action = CookieAction.NONE
 
         return action
 
-    def _load_agent(self, request):
-        cookie_name = self._cookie_name(request.user.get_username())
-        max_age = self._max_cookie_age(request.user.agentsettings)
+    def _process_request(self, request):
+        path = request.path_info.lstrip('/')
 
-        # 'e30=' is base64 for '{}'
-        encoded = request.get_signed_cookie(
-            cookie_name, default='e30=', max_age=max_age
+        if any(pattern.search(path) for pattern in conf.settings.exempt_paths):
+            request.agent = EXEMPT_AGENT
+        else:
+            request.agent = SimpleLazyObject(lambda: self._get_agent(request))
+
+    def _process_response(self, request, response):
+        agent = self._evaluated_agent(request)
+        if agent and (agent is not EXEMPT_AGENT):
+            action = self.cookie_action(request, response, agent)
+            with timing.phase('save'):
+                if action is CookieAction.SAVE:
+                    self._save_agent(agent, response, request)
+                elif action is CookieAction.CLEAR:
+                    self._clear_agent(agent, response, request)
+                elif self._is_consolidated() and self._needs_pruning(request):
+                    self._prune_cookies(agent, response, request)
+
+    def _start_timing(self):
+        """
+        Starts collecting timings if they're enabled. Returns the result of
+        :func:`django_agent_trust.timing.start` or ``None``.
+        """
+        if conf.settings.AGENT_TIMING or conf.settings.AGENT_SERVER_TIMING:
+            return timing.start()
+
+        return None
+
+    def _report_timing(self, request, response, timings):
+        agent_timing.send(
+            sender=type(self), request=request, timings=dict(timings.phases)
         )
 
-        agent = self._decode_cookie(encoded, request.user)
+        if conf.settings.AGENT_SERVER_TIMING and timings.phases:
+            value = timings.server_timing()
+            if response.has_header('Server-Timing'):
+                value = '{0}, {1}'.format(response['Server-Timing'], value)
 
-        if (agent.session is not None) and (
-            agent.session != request.session.get(SESSION_TOKEN_KEY)
-        ):
-            agent = Agent.untrusted_agent(request.user)
+            response['Server-Timing'] = value
 
-        return agent
+    def _get_agent(self, request):
+        user = request.user
 
-    def _decode_cookie(self, encoded, user):
-        agent = None
+        if not user.is_authenticated:
+            return Agent.untrusted_agent(user)
+
+        username = user.get_username()
+
+        if not self._has_cookie(request, username):
+            # Nothing to verify. AgentSettings will be loaded on demand.
+            agent = Agent.untrusted_agent(user)
+        else:
+            # AgentSettings are loaded by _read_agent, unless the cookie has
+            # already expired.
+            denylist.refresh_if_stale()
+            agent, reason = self._load_agent(request, username)
+            self._record_load(username, agent, reason)
+
+        return agent
 
-        content = b64decode(encoded.encode('utf-8')).decode('utf-8')
-        data = json.loads(content)
+    async def _aget_agent(self, request):
+        user = await self._aget_user(request)
 
-        logger.debug('Decoded agent: {0}'.format(data))
+        if user.is_authenticated:
+            username = user.get_username()
 
-        if data.get('username') == user.get_username():
-            agent = Agent.from_jsonable(data, user)
-            if self._should_discard_agent(agent):
-                agent = None
+            if self._has_cookie(request, username):
+                # _read_agent can't query in an async context, so we load
+                # everything it needs here.
+                with timing.phase('settings'):
+                    await AgentSettings.objects.aensure_for_user(user)
+                await denylist.arefresh_if_stale()
+                epoch = await acurrent_epoch()
 
-        if agent is None:
+                agent, reason = await self._aload_agent(request, user, username, epoch)
+                self._record_load(username, agent, reason)
+            else:
+                agent = Agent.untrusted_agent(user)
+        else:
             agent = Agent.untrusted_agent(user)
 
-        logger.debug(
-            'Loaded agent: username={0}, is_trusted={1}, trusted_at={2}, serial={3}'.format(
-                user.get_username(), agent.is_trusted, agent.trusted_at, agent.serial
-            )
+        return agent
+
+    def _has_cookie(self, request, username):
+        return self._user_cookie(request, username) is not None
+
+    def _user_cookie(self, request, username):
+        """
+        Returns the user's signed cookie value, or ``None``.
+
+        In consolidated mode, a legacy per-user cookie is used if the shared
+        cookie doesn't have an entry for the user.
+        """
+        cookie_name = self._cookie_name(username)
+        signed = None
+
+        if self._is_consolidated():
+            signed = self._cookie_entries(request).get(self._cookie_suffix(cookie_name))
+
+        if signed is None:
+            signed = request.COOKIES.get(cookie_name)
+
+        return signed
+
+    def _is_consolidated(self):
+        return conf.settings.AGENT_COOKIE_MODE == 'consolidated'
+
+    def _cookie_entries(self, request):
+        """
+        Parses the consolidated cookie into a dict of user cookie suffixes and
+        signed values, most recently used first.
+        """
+        entries = getattr(request, '_agent_cookie_entries', None)
+
+        if entries is None:
+            entries = {}
+
+            value = request.COOKIES.get(conf.settings.AGENT_COOKIE_NAME, '')
+            for entry in value.split(ENTRY_SEP) if value else []:
+                suffix, _, signed = entry.partition(SUFFIX_SEP)
+                if signed:
+                    entries.setdefault(suffix, signed)
+
+            request._agent_cookie_entries = entries
+
+        return entries
+
+    async def _aget_user(self, request):
+        if hasattr(request, 'auser'):
+            user = await request.auser()
+        else:  # Django < 5.0
+            # Evaluate the lazy user in a thread so we can use it here.
+            await sync_to_async(lambda: request.user.is_authenticated)()
+            user = request.user
+
+        return user
+
+    def _is_pending(self, request):
+        """
+        True if the request's agent is lazy and hasn't been loaded yet.
+        """
+        agent = getattr(request, 'agent', None)
+
+        return isinstance(agent, SimpleLazyObject) and (agent._wrapped is empty)
+
+    def _evaluated_agent(self, request):
+        """
+        Returns the request's agent, or ``None`` if it was never loaded.
+        """
+        agent = getattr(request, 'agent', None)
+
+        if isinstance(agent, SimpleLazyObject):
+            agent = agent._wrapped if (agent._wrapped is not empty) else None
+
+        return agent
+
+    def _load_agent(self, request, username):
+        """
+        Returns a tuple of the agent from the user's cookie and the reason it
+        was discarded, if it was (see
+        :data:`django_agent_trust.stats.DISCARD_REASONS`).
+        """
+        agent, reason = self._read_agent(request, request.user, username)
+
+        if agent.session is not None:
+            with timing.phase('session'):
+                token = request.session.get(SESSION_TOKEN_KEY)
+
+            if agent.session != token:
+                agent, reason = Agent.untrusted_agent(request.user), 'session'
+
+        return agent, reason
+
+    async def _aload_agent(self, request, user, username, epoch):
+        agent, reason = self._read_agent(request, user, username, epoch)
+
+        if agent.session is not None:
+            with timing.phase('session'):
+                if hasattr(request.session, 'aget'):
+                    token = await request.session.aget(SESSION_TOKEN_KEY)
+                else:  # Django < 5.1
+                    token = await sync_to_async(request.session.get)(SESSION_TOKEN_KEY)
+
+            if agent.session != token:
+                agent, reason = Agent.untrusted_agent(user), 'session'
+
+        return agent, reason
+
+    def _record_load(self, username, agent, reason):
+        """
+        Counts and logs the final result of loading an agent from a cookie.
+        """
+        if reason is not None:
+            stats.record_discard(reason)
+
+        stats.record_outcome('trusted' if agent.is_trusted else 'untrusted')
+
+        if _should_log():
+            _log_agent('load', username, agent, reason)
+
+    def _read_agent(self, request, user, username=None, epoch=None):
+        """
+        Loads the agent from the user's cookie, without regard to the session.
+        Returns a tuple of the agent and the reason the cookie was discarded,
+        if it was. ``epoch`` is the current revocation epoch, if it's already
+        known.
+
+        The cookie is first verified against the global inactivity limit. If
+        its precomputed trust expiration has passed, it's rejected without
+        loading the user's AgentSettings.
+        """
+        if username is None:
+            username = user.get_username()
+
+        cookie_name = self._cookie_name(username)
+
+        data, signed_at, reason = self._unsign_cookie(
+            self._user_cookie(request, username), cookie_name, self._max_cookie_age()
+        )
+
+        if self._payload_expired(data):
+            return Agent.untrusted_agent(user), 'expired'
+
+        with timing.phase('settings'):
+            AgentSettings.objects.ensure_for_user(user)
+
+        if data and (time() - signed_at > self._max_cookie_age(user.agentsettings)):
+            data, reason = {}, 'inactive'
+
+        with timing.phase('decode'):
+            agent, payload_reason = self._payload_agent(data, user, username, epoch)
+
+        return agent, reason or payload_reason
+
+    def _verify_cookie(self, signed, cookie_name, max_age):
+        """
+        Verifies a signed cookie value and returns the decoded payload. Missing,
+        invalid, and expired cookies all produce an empty payload.
+        """
+        return self._unsign_cookie(signed, cookie_name, max_age)[0]
+
+    def _unsign_cookie(self, signed, cookie_name, max_age):
+        """
+        Like :meth:`_verify_cookie`, but returns a tuple of the payload, the
+        timestamp of the signature (``None`` if the payload is empty), and the
+        reason the cookie was rejected (``'bad_signature'``, ``'inactive'``, or
+        ``None``).
+
+        Verified payloads are remembered in :attr:`payload_cache`, if enabled.
+        The signature's age is still checked against ``max_age`` each time.
+        """
+        if signed is None:
+            return {}, None, None
+
+        key = (cookie_name, signed, max_age)
+
+        if self.payload_cache is not None:
+            cached = self.payload_cache.get(key)
+            if cached is not None:
+                data, signed_at = cached
+
+                if time() - signed_at <= max_age:
+                    return data, signed_at, None
+
+                return {}, None, 'inactive'
+
+        signer = signing.get_cookie_signer(salt=cookie_name)
+        try:
+            with timing.phase('verify'):
+                encoded = signer.unsign(signed, max_age=max_age)
+        except signing.SignatureExpired:
+            return {}, None, 'inactive'
+        except signing.BadSignature:
+            return {}, None, 'bad_signature'
+
+        with timing.phase('decode'):
+            data = self._decode_payload(encoded)
+        signed_at = signing.b62_decode(signed.rsplit(signer.sep, 2)[1])
+
+        if self.payload_cache is not None:
+            self.payload_cache.set(key, (data, signed_at))
+
+        return data, signed_at, None
+
+    def _payload_expired(self, data):
+        """
+        True if a payload's precomputed trust expiration has passed.
+        """
+        expires = data.get('expires')
+
+        return (expires is not None) and (expires < time())
+
+    def _decode_cookie(self, encoded, user):
+        agent, _ = self._payload_agent(
+            self._decode_payload(encoded), user, user.get_username()
         )
 
         return agent
 
+    def _payload_agent(self, data, user, username, epoch=None):
+        """
+        Returns a tuple of the agent from a verified payload and the reason it
+        was discarded, if it was.
+        """
+        agent = None
+        reason = None
+
+        if self._payload_matches_user(data, username):
+            agent = Agent.from_jsonable(data, user, username)
+            reason = self._discard_reason(agent, epoch)
+        elif data:
+            reason = 'username'
+
+        if (agent is None) or (reason is not None):
+            agent = Agent.untrusted_agent(user)
+
+        return agent, reason
+
+    def _decode_payload(self, encoded):
+        if codec.is_compact(encoded):
+            data = codec.decode(encoded)
+        else:
+            content = b64decode(encoded.encode('utf-8')).decode('utf-8')
+            data = json.loads(content)
+
+        return data
+
+    def _payload_matches_user(self, data, username):
+        if 'username_digest' in data:
+            matches = data['username_digest'] == codec.username_digest(username)
+        else:
+            matches = data.get('username') == username
+
+        return matches
+
     def _should_discard_agent(self, agent):
+        return self._discard_reason(agent) is not None
+
+    def _discard_reason(self, agent, epoch=None):
+        """
+        Returns the reason to discard an agent loaded from a cookie (see
+        :data:`django_agent_trust.stats.DISCARD_REASONS`), or ``None`` to keep
+        it. ``epoch`` defaults to :func:`~django_agent_trust.revocation.current_epoch`.
+        """
+        if epoch is None:
+            epoch = current_epoch()
+
+        if agent.epoch < epoch:
+            return 'epoch'
+
+        if (agent.agent_id is not None) and (agent.agent_id in denylist):
+            return 'revoked'
+
         expiration = agent.trust_expiration
         if (expiration is not None) and (expiration < datetime.now()):
-            return True
+            return 'expired'
 
         if agent.serial < agent.user.agentsettings.serial:
+            return 'serial'
+
+        return None
+
+    def _needs_refresh(self, agent):
+        """
+        True if a trusted agent's cookie should be reissued. See
+        :setting:`AGENT_COOKIE_REFRESH_FRACTION`.
+        """
+        fraction = conf.settings.AGENT_COOKIE_REFRESH_FRACTION
+
+        if (fraction is None) or (agent.refreshed_at is None):
             return True
 
-        return False
+        max_age = self._max_cookie_age(agent.user.agentsettings)
+        age = (datetime.now() - agent.refreshed_at).total_seconds()
 
-    def _save_agent(self, agent, response):
-        logger.debug(
-            'Saving agent: username={0}, is_trusted={1}, trusted_at={2}, serial={3}'.format(
-                agent.user.get_username(),
-                agent.is_trusted,
-                agent.trusted_at,
-                agent.serial,
-            )
-        )
+        return age >= max_age * fraction
+
+    def _save_agent(self, agent, response, request):
+        if _should_log():
+            _log_agent('save', agent.username, agent)
 
-        cookie_name = self._cookie_name(agent.user.get_username())
+        cookie_name = self._cookie_name(agent.username)
         encoded = self._encode_cookie(agent, agent.user)
-        max_age = self._max_cookie_age(agent.user.agentsettings)
 
-        response.set_signed_cookie(
-            cookie_name,
-            encoded,
-            max_age=max_age,
-            path=settings.AGENT_COOKIE_PATH,
-            domain=settings.AGENT_COOKIE_DOMAIN,
-            secure=settings.AGENT_COOKIE_SECURE,
-            httponly=settings.AGENT_COOKIE_HTTPONLY,
-        )
+        if self._is_consolidated():
+            signed = signing.get_cookie_signer(salt=cookie_name).sign(encoded)
+            self._save_entries(request, response, cookie_name, signed)
+        else:
+            response.set_signed_cookie(
+                cookie_name,
+                encoded,
+                max_age=self._max_cookie_age(agent.user.agentsettings),
+                **conf.settings.cookie_kwargs,
+            )
+
+    def _clear_agent(self, agent, response, request):
+        if _should_log():
+            _log_agent('clear', agent.username, agent)
 
-    def _clear_agent(self, agent, response):
-        logger.debug(
-            'Clearing agent: username={0}, serial={1}'.format(
-                agent.user.get_username(), agent.serial
+        cookie_name = self._cookie_name(agent.username)
+
+        if self._is_consolidated():
+            self._save_entries(request, response, cookie_name, None)
+        else:
+            response.delete_cookie(
+                cookie_name,
+                **conf.settings.delete_cookie_kwargs,
             )
-        )
 
-        cookie_name = self._cookie_name(agent.user.get_username())
+    def _prune_cookies(self, agent, response, request):
+        """
+        Rewrites the consolidated cookie without stale entries, leaving the
+        current user's trust as it is.
+        """
+        if agent.user.is_anonymous:
+            cookie_name, signed = None, None
+        else:
+            cookie_name = self._cookie_name(agent.username)
+            signed = self._user_cookie(request, agent.username)
 
-        response.delete_cookie(
-            cookie_name,
-            path=settings.AGENT_COOKIE_PATH,
-            domain=settings.AGENT_COOKIE_DOMAIN,
-        )
+        self._save_entries(request, response, cookie_name, signed)
+
+    def _needs_pruning(self, request):
+        entries = self._cookie_entries(request)
+
+        if len(entries) > conf.settings.AGENT_COOKIE_MAX_USERS:
+            return True
+
+        if any(self._is_stale(signed) for signed in entries.values()):
+            return True
+
+        return any(self._is_legacy_cookie(name) for name in request.COOKIES)
+
+    def _save_entries(self, request, response, cookie_name, signed):
+        """
+        Writes the consolidated cookie with the given user's entry first (or
+        removed, if ``signed`` is ``None``), followed by other users' entries
+        in order of recent use. Stale entries and entries beyond
+        :setting:`AGENT_COOKIE_MAX_USERS` are dropped, as are any legacy
+        per-user cookies.
+        """
+        entries = dict(self._cookie_entries(request))
+
+        if cookie_name is not None:
+            suffix = self._cookie_suffix(cookie_name)
+            entries.pop(suffix, None)
+            if signed is not None:
+                entries = {suffix: signed, **entries}
+
+        items = [
+            SUFFIX_SEP.join(item)
+            for item in entries.items()
+            if not self._is_stale(item[1])
+        ]
+        items = items[: conf.settings.AGENT_COOKIE_MAX_USERS]
+
+        if items:
+            response.set_cookie(
+                conf.settings.AGENT_COOKIE_NAME,
+                ENTRY_SEP.join(items),
+                max_age=self._max_cookie_age(),
+                **conf.settings.cookie_kwargs,
+            )
+        elif conf.settings.AGENT_COOKIE_NAME in request.COOKIES:
+            response.delete_cookie(
+                conf.settings.AGENT_COOKIE_NAME,
+                **conf.settings.delete_cookie_kwargs,
+            )
+
+        for name in request.COOKIES:
+            if self._is_legacy_cookie(name):
+                response.delete_cookie(
+                    name,
+                    **conf.settings.delete_cookie_kwargs,
+                )
+
+    def _is_stale(self, signed):
+        """
+        True if a signed value is older than the global inactivity limit. The
+        signature itself isn't checked.
+        """
+        try:
+            # Signed values end with ":<timestamp>:<signature>".
+            signed_at = signing.b62_decode(signed.rsplit(':', 2)[1])
+        except (IndexError, ValueError):
+            return True
+
+        return time() - signed_at > self._max_cookie_age()
+
+    def _is_legacy_cookie(self, name):
+        prefix, _, suffix = name.rpartition('-')
+
+        return (prefix == conf.settings.AGENT_COOKIE_NAME) and (len(suffix) == 16)
 
     def _encode_cookie(self, agent, user):
         data = agent.to_jsonable()
-        content = json.dumps(data)
-        encoded = b64encode(content.encode('utf-8')).decode('utf-8')
+        data['refreshed_at'] = int(time())
+
+        if (conf.settings.AGENT_COOKIE_FORMAT == 'compact') and codec.can_encode(data):
+            encoded = codec.encode(data)
+        else:
+            content = json.dumps(data)
+            encoded = b64encode(content.encode('utf-8')).decode('utf-8')
 
         return encoded
 
@@ -184,21 +726,23 @@ class AgentMiddleware(object):
     def _cookie_name(cls, username):
         suffix = md5(username.encode('utf-8')).hexdigest()[16:]
 
-        return '{0}-{1}'.format(settings.AGENT_COOKIE_NAME, suffix)
+        return '{0}-{1}'.format(conf.settings.AGENT_COOKIE_NAME, suffix)
+
+    @classmethod
+    def _cookie_suffix(cls, cookie_name):
+        return cookie_name[-16:]
 
-    def _max_cookie_age(self, agentsettings):
+    def _max_cookie_age(self, agentsettings=None):
         """
-        Returns the max cookie age based on inactivity limits.
+        Returns the max cookie age based on inactivity limits. Without
+        ``agentsettings``, this is the global limit.
         """
-        days = settings.AGENT_INACTIVITY_DAYS
+        max_age = conf.settings.max_cookie_age
 
-        try:
-            int(days) * 86400
-        except Exception:
-            raise ImproperlyConfigured('AGENT_INACTIVITY_DAYS must be a number.')
-
-        user_days = agentsettings.inactivity_days
-        if (user_days is not None) and (user_days < days):
-            days = user_days
+        user_days = (
+            agentsettings.inactivity_days if (agentsettings is not None) else None
+        )
+        if (user_days is not None) and (user_days * 86400 < max_age):
+            max_age = user_days * 86400
 
-        return days * 86400
+        return max_age
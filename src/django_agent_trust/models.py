@@ -1,10 +1,17 @@
 from datetime import datetime, timedelta
 from time import mktime
+from zlib import crc32
+
+from asgiref.sync import sync_to_async
 
 import django.conf
-from django.db import IntegrityError, models
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import F
 
-from .conf import settings
+from . import cache, conf
+from .revocation import current_epoch, denylist, new_agent_id
 
 
 SESSION_TOKEN_KEY = 'django-agent-trust-token'
@@ -14,15 +21,221 @@ class AgentSettingsManager(models.Manager):
     def ensure_for_user(self, user):
         """
         Loads a user's AgentSettings instance, creating a default if necessary.
+        With :setting:`AGENT_SETTINGS_SPARSE`, the default is not saved.
+
+        Nothing is queried if the settings were already loaded with
+        ``select_related('agentsettings')`` (see
+        :class:`~django_agent_trust.backends.AgentSettingsBackendMixin`). If
+        :setting:`AGENT_SETTINGS_CACHE` is set, this will try the cache before
+        going to the database.
+        """
+        relation = self._relation()
+        if relation.is_cached(user):
+            if relation.get_cached_value(user) is None:  # Known to be missing.
+                user.agentsettings = self._missing_for_user(user)
+            return
+
+        agentsettings, version = cache.get_agentsettings(
+            self.model, user, using=self.db
+        )
+        if agentsettings is not None:
+            user.agentsettings = agentsettings
+            return
+
+        try:
+            agentsettings = user.agentsettings
+        except self.model.DoesNotExist:
+            agentsettings = self._missing_for_user(user)
+
+        user.agentsettings = agentsettings
+        cache.set_agentsettings(agentsettings, version)
+
+    async def aensure_for_user(self, user):
         """
+        Async version of :meth:`ensure_for_user`.
+        """
+        relation = self._relation()
+        if relation.is_cached(user):
+            if relation.get_cached_value(user) is None:  # Known to be missing.
+                user.agentsettings = await self._amissing_for_user(user)
+            return
+
+        agentsettings, version = await cache.aget_agentsettings(
+            self.model, user, using=self.db
+        )
+        if agentsettings is not None:
+            user.agentsettings = agentsettings
+            return
+
         try:
-            user.agentsettings
+            agentsettings = await self.aget(user=user)
         except self.model.DoesNotExist:
-            user.agentsettings = self.model(user=user)
-            try:
-                user.agentsettings.save()
-            except IntegrityError:  # Trap and ignore the race condition.
-                pass
+            agentsettings = await self._amissing_for_user(user)
+
+        user.agentsettings = agentsettings
+        await cache.aset_agentsettings(agentsettings, version)
+
+    def _missing_for_user(self, user):
+        """
+        Returns settings for a user who has none in the database.
+        """
+        if conf.settings.AGENT_SETTINGS_SPARSE:
+            agentsettings = self.model(user=user)
+        else:
+            agentsettings = self._create_for_user(user)
+
+        return agentsettings
+
+    async def _amissing_for_user(self, user):
+        if conf.settings.AGENT_SETTINGS_SPARSE:
+            agentsettings = self.model(user=user)
+        else:
+            agentsettings = await sync_to_async(self._create_for_user)(user)
+
+        return agentsettings
+
+    def _create_for_user(self, user):
+        """
+        Creates default settings for a user, or loads them if another request
+        beat us to it. The INSERT runs in a savepoint, so losing the race
+        doesn't break an enclosing transaction (e.g. with ATOMIC_REQUESTS).
+        """
+        db = router.db_for_write(self.model)
+        # Setting user_id rather than user leaves user's relation cache alone.
+        agentsettings = self.model(user_id=user.pk)
+
+        try:
+            with transaction.atomic(using=db):
+                agentsettings.save(force_insert=True, using=db)
+        except IntegrityError:
+            agentsettings = self.using(db).get(user_id=user.pk)
+
+        return agentsettings
+
+    def bump_serials(
+        self, users=None, batch_size=1000, start_after=None, progress=None
+    ):
+        """
+        Increments the serial for many users at once, revoking all of their
+        trusted agents. This is intended for mass trust resets.
+
+        Users are processed in primary key order, in batches of ``batch_size``.
+        Each batch is one transaction that creates any missing AgentSettings
+        and then bumps all of the serials with a single ``UPDATE``.
+
+        :param users: A queryset of users. ``None`` for all users.
+        :param int batch_size: The number of users per batch.
+        :param start_after: Only process users with primary keys greater than
+            this. Use this to resume an interrupted run.
+        :param progress: An optional callable that will be passed the total
+            number of users processed so far and the last primary key after
+            each batch.
+
+        :returns: The number of users processed.
+        :rtype: int
+        """
+        if users is None:
+            users = get_user_model()._default_manager.all()
+
+        pks = users.order_by('pk').values_list('pk', flat=True)
+        db = router.db_for_write(self.model)
+        count = 0
+
+        while True:
+            if start_after is not None:
+                batch = list(pks.filter(pk__gt=start_after)[:batch_size])
+            else:
+                batch = list(pks[:batch_size])
+
+            if not batch:
+                break
+
+            with transaction.atomic(using=db):
+                self._create_missing(batch, db)
+                self.using(db).filter(user__in=batch).update(serial=F('serial') + 1)
+
+            cache.invalidate_many(batch)
+
+            count += len(batch)
+            start_after = batch[-1]
+
+            if progress is not None:
+                progress(count, start_after)
+
+        return count
+
+    def backfill(self, users=None, batch_size=1000, progress=None):
+        """
+        Creates default AgentSettings for users that don't have them, such as
+        users created with ``bulk_create``, by a data import, or with raw SQL.
+        Running this after an import keeps the middleware from having to
+        create rows on demand.
+
+        Users without settings are found with an anti-join and inserted with
+        ``bulk_create(ignore_conflicts=True)``, ``batch_size`` at a time.
+
+        :param users: A queryset of users. ``None`` for all users.
+        :param int batch_size: The number of rows to insert per batch.
+        :param progress: An optional callable that will be passed the total
+            number of users processed so far and the last primary key after
+            each batch.
+
+        :returns: The number of users processed.
+        :rtype: int
+        """
+        if users is None:
+            users = get_user_model()._default_manager.all()
+
+        pks = (
+            users.filter(agentsettings__isnull=True)
+            .order_by('pk')
+            .values_list('pk', flat=True)
+        )
+        count = 0
+        last_pk = None
+
+        while True:
+            if last_pk is not None:
+                batch = list(pks.filter(pk__gt=last_pk)[:batch_size])
+            else:
+                batch = list(pks[:batch_size])
+
+            if not batch:
+                break
+
+            self.bulk_create(
+                [self.model(user_id=pk) for pk in batch], ignore_conflicts=True
+            )
+
+            count += len(batch)
+            last_pk = batch[-1]
+
+            if progress is not None:
+                progress(count, last_pk)
+
+        return count
+
+    def _create_missing(self, user_pks, db):
+        """
+        Creates default AgentSettings for any of the given users that lack
+        them.
+        """
+        queryset = self.using(db)
+        existing = set(
+            queryset.filter(user__in=user_pks).values_list('user_id', flat=True)
+        )
+
+        queryset.bulk_create(
+            [self.model(user_id=pk) for pk in user_pks if pk not in existing],
+            ignore_conflicts=True,
+        )
+
+    def _relation(self):
+        """
+        The reverse relation from users to AgentSettings, which caches them on
+        user objects.
+        """
+        return self.model._meta.get_field('user').remote_field
 
 
 class AgentSettings(models.Model):
@@ -75,6 +288,80 @@ class AgentSettings(models.Model):
     def __str__(self):
         return "AgentSettings: {0}".format(self.user.get_username())
 
+    def bump_serial(self):
+        """
+        Increments :attr:`serial`, revoking all previously trusted agents.
+
+        This is a single ``UPDATE`` of the serial column, so concurrent calls
+        won't lose increments. The new value is loaded into this instance. If
+        this is an unsaved default (see :setting:`AGENT_SETTINGS_SPARSE`), the
+        row is created first.
+        """
+        if self.pk is None:
+            self.pk = type(self).objects._create_for_user(self.user).pk
+            self._state.adding = False
+
+        with transaction.atomic(using=self._state.db):
+            type(self).objects.filter(pk=self.pk).update(serial=F('serial') + 1)
+            self.refresh_from_db(fields=['serial'])
+
+        cache.invalidate(self.user_id)
+
+
+class RevokedAgentManager(models.Manager):
+    def revoke(self, user, agent_id):
+        """
+        Adds an agent to the denylist. Agents are identified by
+        :attr:`Agent.agent_id`. This process stops trusting the agent
+        once the current transaction commits; others will within
+        :setting:`AGENT_DENYLIST_TTL` seconds.
+
+        :param user: The user that trusted the agent.
+        :param int agent_id: The agent's ID.
+        """
+        revoked = self.create(user=user, agent_id=agent_id)
+        transaction.on_commit(
+            lambda: denylist.add(agent_id), using=router.db_for_write(self.model)
+        )
+
+        return revoked
+
+
+class RevokedAgent(models.Model):
+    """
+    An individual agent whose trust has been revoked.
+
+    .. attribute:: user
+
+        *ForeignKey*: The user that trusted the agent.
+
+    .. attribute:: agent_id
+
+        *BigIntegerField*: The revoked :attr:`Agent.agent_id`.
+
+    .. attribute:: revoked_at
+
+        *DateTimeField*: When the agent was revoked.
+    """
+
+    user = models.ForeignKey(
+        django.conf.settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+
+    agent_id = models.BigIntegerField()
+
+    revoked_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = RevokedAgentManager()
+
+    def __str__(self):
+        return "RevokedAgent: {0} {1}".format(self.user.get_username(), self.agent_id)
+
+
+# Marks lazy attributes that haven't been computed.
+_UNSET = object()
+
 
 class Agent(object):
     """
@@ -84,18 +371,102 @@ class Agent(object):
     the APIs below to manipulate trust.
     """
 
-    def __init__(self, user, is_trusted, trusted_at, trust_days, serial, session):
-        self._user = user
-        self._is_trusted = is_trusted
-        self._trusted_at = (
-            trusted_at.replace(microsecond=0) if (trusted_at is not None) else None
+    __slots__ = (
+        '_user',
+        '_username',
+        '_is_trusted',
+        '_trusted_at',
+        '_trust_days',
+        '_serial',
+        '_session',
+        '_refreshed_at',
+        '_epoch',
+        '_agent_id',
+        '_expires',
+        '_stamp',
+        '_trust_expiration',
+    )
+
+    def __init__(
+        self,
+        user,
+        is_trusted,
+        trusted_at,
+        trust_days,
+        serial,
+        session,
+        refreshed_at=None,
+        epoch=0,
+        agent_id=None,
+        expires=None,
+        stamp=None,
+        username=None,
+    ):
+        init = object.__setattr__
+
+        init(self, '_user', user)
+        init(self, '_username', username)
+        init(self, '_is_trusted', is_trusted)
+        init(
+            self,
+            '_trusted_at',
+            trusted_at.replace(microsecond=0) if (trusted_at is not None) else None,
         )
-        self._trust_days = trust_days
-        self._serial = serial
-        self._session = session
+        init(self, '_trust_days', trust_days)
+        init(self, '_serial', serial)
+        init(self, '_session', session)
+        init(
+            self,
+            '_refreshed_at',
+            refreshed_at.replace(microsecond=0) if (refreshed_at is not None) else None,
+        )
+        init(self, '_epoch', epoch)
+        init(self, '_agent_id', agent_id)
+
+        # A trust expiration that was computed under the settings identified
+        # by stamp. See settings_stamp().
+        init(self, '_expires', expires)
+        init(self, '_stamp', stamp)
+
+        init(self, '_trust_expiration', _UNSET)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Agent objects are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Agent objects are immutable.")
+
+    def _replace(self, **kwargs):
+        """
+        Returns a copy of this agent with some fields replaced.
+        """
+        fields = {
+            'user': self._user,
+            'is_trusted': self._is_trusted,
+            'trusted_at': self._trusted_at,
+            'trust_days': self._trust_days,
+            'serial': self._serial,
+            'session': self._session,
+            'refreshed_at': self._refreshed_at,
+            'epoch': self._epoch,
+            'agent_id': self._agent_id,
+            'expires': self._expires,
+            'stamp': self._stamp,
+            'username': self._username,
+        }
+        fields.update(kwargs)
+
+        return type(self)(**fields)
 
     @classmethod
     def untrusted_agent(cls, user):
+        """
+        Returns an untrusted agent for a user. All anonymous users share a
+        single instance.
+        """
+        if user.is_anonymous:
+            return UNTRUSTED_AGENT
+
         return cls(user, False, None, None, -1, None)
 
     @classmethod
@@ -103,8 +474,17 @@ class Agent(object):
         if user.is_anonymous:
             raise ValueError("Can't create a trusted agent for an anonymous user.")
 
+        AgentSettings.objects.ensure_for_user(user)
+
         return cls(
-            user, True, datetime.now(), trust_days, user.agentsettings.serial, None
+            user,
+            True,
+            datetime.now(),
+            trust_days,
+            user.agentsettings.serial,
+            None,
+            epoch=current_epoch(),
+            agent_id=new_agent_id(),
         )
 
     @classmethod
@@ -112,12 +492,37 @@ class Agent(object):
         if user.is_anonymous:
             raise ValueError("Can't create a trusted agent for an anonymous user.")
 
-        return cls(user, True, datetime.now(), None, user.agentsettings.serial, token)
+        AgentSettings.objects.ensure_for_user(user)
+
+        return cls(
+            user,
+            True,
+            datetime.now(),
+            None,
+            user.agentsettings.serial,
+            token,
+            epoch=current_epoch(),
+            agent_id=new_agent_id(),
+        )
 
     @property
     def user(self):
         return self._user
 
+    @property
+    def username(self):
+        """
+        The user's username, cached.
+        """
+        if self._username is None:
+            user = self._user
+            username = (
+                user.get_username() if hasattr(user, 'get_username') else user.username
+            )
+            object.__setattr__(self, '_username', username)
+
+        return self._username
+
     @property
     def is_trusted(self):
         """
@@ -151,14 +556,38 @@ class Agent(object):
     def session(self):
         return self._session
 
+    @property
+    def refreshed_at(self):
+        """
+        The datetime at which this agent's cookie was last issued, if any.
+        """
+        return self._refreshed_at
+
+    @property
+    def epoch(self):
+        """
+        The revocation epoch in which this agent was trusted.
+        """
+        return self._epoch
+
+    @property
+    def agent_id(self):
+        """
+        A random identifier assigned when this agent was trusted, which can be
+        passed to :meth:`RevokedAgentManager.revoke
+        <django_agent_trust.models.RevokedAgentManager.revoke>`. ``None`` for
+        untrusted agents and agents trusted by older versions.
+        """
+        return self._agent_id
+
     @property
     def trust_expiration(self):
         """
         The datetime at which trust in this agent expires. ``None`` if the
         agent is not trusted or does not expire.
         """
-        if not hasattr(self, '_trust_expiration'):
-            self._trust_expiration = self._get_trust_expiration()
+        if self._trust_expiration is _UNSET:
+            object.__setattr__(self, '_trust_expiration', self._get_trust_expiration())
 
         return self._trust_expiration
 
@@ -166,10 +595,16 @@ class Agent(object):
         if (not self.is_trusted) or (self.trusted_at is None):
             return None
 
+        stamp = settings_stamp(self.user.agentsettings)
+        if stamp == self._stamp:
+            return self._expires
+
+        object.__setattr__(self, '_stamp', stamp)
+
         prefs = [
             d
             for d in [
-                settings.AGENT_TRUST_DAYS,
+                conf.settings.AGENT_TRUST_DAYS,
                 self.user.agentsettings.trust_days,
                 self.trust_days,
             ]
@@ -185,35 +620,79 @@ class Agent(object):
 
     def to_jsonable(self):
         return {
-            'username': (
-                self.user.get_username()
-                if hasattr(self.user, 'get_username')
-                else self.user.username
-            ),
+            'username': self.username,
             'is_trusted': self.is_trusted,
             'trusted_at': self._trusted_at_timestamp(),
             'trust_days': self.trust_days,
             'serial': self.serial,
             'session': self.session,
+            'refreshed_at': self._timestamp(self.refreshed_at),
+            'epoch': self.epoch,
+            'agent_id': self.agent_id,
+            'expires': self._timestamp(self.trust_expiration),
+            'stamp': self._stamp,
         }
 
     def _trusted_at_timestamp(self):
-        if self.trusted_at is not None:
-            timestamp = int(mktime(self.trusted_at.timetuple()))
+        return self._timestamp(self.trusted_at)
+
+    @staticmethod
+    def _timestamp(dt):
+        if dt is not None:
+            timestamp = int(mktime(dt.timetuple()))
         else:
             timestamp = None
 
         return timestamp
 
     @classmethod
-    def from_jsonable(cls, jsonable, user):
+    def from_jsonable(cls, jsonable, user, username=None):
         is_trusted = jsonable.get('is_trusted', False)
         trusted_at = jsonable.get('trusted_at', None)
         trust_days = jsonable.get('trust_days', None)
         serial = jsonable.get('serial', -1)
         session = jsonable.get('session', None)
+        refreshed_at = jsonable.get('refreshed_at', None)
+        epoch = jsonable.get('epoch', 0)
+        agent_id = jsonable.get('agent_id', None)
+        expires = jsonable.get('expires', None)
+        stamp = jsonable.get('stamp', None)
 
         if trusted_at is not None:
             trusted_at = datetime.fromtimestamp(trusted_at)
 
-        return cls(user, is_trusted, trusted_at, trust_days, serial, session)
+        if refreshed_at is not None:
+            refreshed_at = datetime.fromtimestamp(refreshed_at)
+
+        if expires is not None:
+            expires = datetime.fromtimestamp(expires)
+
+        return cls(
+            user,
+            is_trusted,
+            trusted_at,
+            trust_days,
+            serial,
+            session,
+            refreshed_at,
+            epoch,
+            agent_id,
+            expires,
+            stamp,
+            username,
+        )
+
+
+# Shared by all anonymous users.
+UNTRUSTED_AGENT = Agent(AnonymousUser(), False, None, None, -1, None)
+
+
+def settings_stamp(agentsettings):
+    """
+    Returns a fingerprint of the settings that determine trust expiration. A
+    trust expiration that was computed under the same fingerprint is still
+    valid.
+    """
+    key = '{0!r}:{1!r}'.format(conf.settings.AGENT_TRUST_DAYS, agentsettings.trust_days)
+
+    return crc32(key.encode('utf-8'))
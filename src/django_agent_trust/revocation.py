@@ -0,0 +1,218 @@
+"""
+Site-wide and per-agent revocation of agent trust.
+
+Every trusted agent records the revocation epoch that was current when it was
+trusted. The current epoch is the sum of :setting:`AGENT_TRUST_EPOCH` and a
+counter kept in :setting:`AGENT_EPOCH_CACHE`; agents from earlier epochs are
+discarded. Advancing the counter is a single cache operation, regardless of the
+number of users.
+
+The counter is cached in each process for :setting:`AGENT_EPOCH_TTL` seconds,
+so other processes notice a new epoch within that time.
+
+Individual agents are revoked by adding their IDs to a denylist in the
+database (:class:`~django_agent_trust.models.RevokedAgent`). Each process keeps
+the IDs in memory and loads new entries at most once every
+:setting:`AGENT_DENYLIST_TTL` seconds, so checking an agent never needs a
+query.
+"""
+
+from datetime import timedelta
+from secrets import randbits
+from threading import Lock
+from time import monotonic
+
+from asgiref.sync import sync_to_async
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from . import conf
+
+
+EPOCH_KEY = 'django_agent_trust:epoch'
+
+# (counter, expires at)
+_cached_counter = (0, 0.0)
+
+
+def current_epoch():
+    """
+    Returns the current revocation epoch.
+    """
+    return conf.settings.AGENT_TRUST_EPOCH + _epoch_counter()
+
+
+async def acurrent_epoch():
+    """
+    Async version of :func:`current_epoch`.
+    """
+    return conf.settings.AGENT_TRUST_EPOCH + await _aepoch_counter()
+
+
+def revoke_all_agents():
+    """
+    Advances the epoch counter in :setting:`AGENT_EPOCH_CACHE`, revoking trust
+    in every agent that is currently trusted. Returns the new epoch.
+    """
+    global _cached_counter
+
+    cache = _get_cache()
+    if cache is None:
+        raise ImproperlyConfigured(
+            "AGENT_EPOCH_CACHE must be set in order to revoke all agents."
+        )
+
+    cache.add(EPOCH_KEY, 0, timeout=None)
+    counter = cache.incr(EPOCH_KEY)
+    _cached_counter = (counter, monotonic() + conf.settings.AGENT_EPOCH_TTL)
+
+    return conf.settings.AGENT_TRUST_EPOCH + counter
+
+
+def reset():
+    """
+    Forgets the counter cached in this process.
+    """
+    global _cached_counter
+
+    _cached_counter = (0, 0.0)
+
+
+def _epoch_counter():
+    global _cached_counter
+
+    cache = _get_cache()
+    if cache is None:
+        return 0
+
+    counter, expires_at = _cached_counter
+    now = monotonic()
+    if now >= expires_at:
+        counter = cache.get(EPOCH_KEY, 0)
+        _cached_counter = (counter, now + conf.settings.AGENT_EPOCH_TTL)
+
+    return counter
+
+
+async def _aepoch_counter():
+    global _cached_counter
+
+    cache = _get_cache()
+    if cache is None:
+        return 0
+
+    counter, expires_at = _cached_counter
+    now = monotonic()
+    if now >= expires_at:
+        counter = await cache.aget(EPOCH_KEY, 0)
+        _cached_counter = (counter, now + conf.settings.AGENT_EPOCH_TTL)
+
+    return counter
+
+
+def _get_cache():
+    alias = conf.settings.AGENT_EPOCH_CACHE
+
+    return caches[alias] if (alias is not None) else None
+
+
+def new_agent_id():
+    """
+    Returns a random ID for a newly trusted agent.
+    """
+    return randbits(63) or 1
+
+
+class Denylist(object):
+    """
+    The IDs of revoked agents, loaded incrementally from
+    :class:`~django_agent_trust.models.RevokedAgent`.
+
+    Membership tests only consult memory. Call :meth:`refresh_if_stale` (or
+    :meth:`arefresh_if_stale`) before a batch of tests to pick up new entries.
+
+    Rows don't necessarily become visible in the order they were created: a
+    transaction can commit its row after a later one has already been loaded.
+    Each refresh therefore re-reads everything revoked within :attr:`overlap`
+    of the newest entry it has seen, and everything is reloaded every
+    :attr:`full_reload_interval` seconds in case a transaction took longer.
+    """
+
+    #: How far back each incremental refresh looks.
+    overlap = timedelta(minutes=5)
+
+    #: Seconds between full reloads.
+    full_reload_interval = 3600
+
+    def __init__(self):
+        self._ids = set()
+        self._newest = None
+        self._expires_at = 0.0
+        self._reload_at = 0.0
+        self._lock = Lock()
+
+    def __contains__(self, agent_id):
+        return agent_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, agent_id):
+        self._ids.add(agent_id)
+
+    def is_stale(self):
+        return monotonic() >= self._expires_at
+
+    def refresh_if_stale(self):
+        if self.is_stale():
+            self._refresh(force=False)
+
+    async def arefresh_if_stale(self):
+        if self.is_stale():
+            await sync_to_async(self._refresh)(force=False)
+
+    def refresh(self):
+        """
+        Loads any entries added since the last refresh.
+        """
+        self._refresh(force=True)
+
+    def _refresh(self, force):
+        from .models import RevokedAgent
+
+        with self._lock:
+            now = monotonic()
+            if (not force) and (now < self._expires_at):
+                # Another thread refreshed while we were waiting.
+                return
+
+            rows = RevokedAgent.objects.all()
+
+            if (self._newest is not None) and (now < self._reload_at):
+                ids = self._ids
+                rows = rows.filter(revoked_at__gte=self._newest - self.overlap)
+            else:
+                ids = set()
+                self._reload_at = now + self.full_reload_interval
+
+            for agent_id, revoked_at in rows.values_list('agent_id', 'revoked_at'):
+                ids.add(agent_id)
+                if (self._newest is None) or (revoked_at > self._newest):
+                    self._newest = revoked_at
+
+            self._ids = ids
+            self._expires_at = now + conf.settings.AGENT_DENYLIST_TTL
+
+    def reset(self):
+        """
+        Forgets everything, so that the next refresh reloads all entries.
+        """
+        with self._lock:
+            self._ids = set()
+            self._newest = None
+            self._expires_at = 0.0
+            self._reload_at = 0.0
+
+
+denylist = Denylist()
@@ -1,11 +1,27 @@
 from django.conf import settings
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
 
+from . import cache, conf
 from .models import AgentSettings
 
 
+#: Sent by :class:`~django_agent_trust.middleware.AgentMiddleware` after each
+#: request when :setting:`AGENT_TIMING` or :setting:`AGENT_SERVER_TIMING` is
+#: enabled. ``request`` is the request and ``timings`` is a dict mapping phase
+#: names to seconds.
+agent_timing = Signal()
+
+
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def init_agent_settings(sender, instance, created=False, raw=False, **kwargs):
+    if conf.settings.AGENT_SETTINGS_SPARSE:
+        return
+
     if instance and created and (not raw):
         AgentSettings.objects.ensure_for_user(instance)
+
+
+@receiver([post_save, post_delete], sender=AgentSettings)
+def invalidate_agent_settings(sender, instance, **kwargs):
+    cache.invalidate(instance.user_id)
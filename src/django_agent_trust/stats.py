@@ -0,0 +1,136 @@
+"""
+In-process counters of what the middleware made of agent cookies.
+
+Every authenticated request whose agent is loaded from a cookie counts one
+outcome (``trusted`` or ``untrusted``). When a cookie is rejected, the reason
+is counted as well:
+
+* ``bad_signature``: the signature was invalid (e.g. ``SECRET_KEY`` changed).
+* ``inactive``: the cookie is older than the inactivity limit.
+* ``username``: the cookie belongs to another user.
+* ``epoch``: all agents were revoked by advancing the epoch.
+* ``revoked``: the agent was revoked individually.
+* ``expired``: trust expired.
+* ``serial``: the user's agents were revoked.
+* ``session``: trust was scoped to an earlier session.
+
+The counters belong to the current process. :func:`prometheus_text` renders
+them for scraping and :setting:`AGENT_STATS_CALLBACK` can forward each
+increment to another system, such as statsd.
+"""
+
+from functools import lru_cache
+from threading import Lock
+
+from django.utils.module_loading import import_string
+
+from . import conf
+
+
+#: Possible outcomes.
+OUTCOMES = ['trusted', 'untrusted']
+
+#: Reasons for discarding an agent cookie.
+DISCARD_REASONS = [
+    'bad_signature',
+    'inactive',
+    'username',
+    'epoch',
+    'revoked',
+    'expired',
+    'serial',
+    'session',
+]
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counters(object):
+    """
+    A thread-safe set of named counters.
+    """
+
+    def __init__(self, names):
+        self._counts = dict.fromkeys(names, 0)
+        self._lock = Lock()
+
+    def incr(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def snapshot(self):
+        """
+        Returns a dict of the current counts.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict.fromkeys(self._counts, 0)
+
+
+outcomes = Counters(OUTCOMES)
+discards = Counters(DISCARD_REASONS)
+
+
+def record_outcome(outcome):
+    outcomes.incr(outcome)
+    _notify('outcome.' + outcome)
+
+
+def record_discard(reason):
+    discards.incr(reason)
+    _notify('discard.' + reason)
+
+
+def reset():
+    """
+    Sets all counters in this process to zero.
+    """
+    outcomes.reset()
+    discards.reset()
+
+
+def prometheus_text():
+    """
+    Returns the counters in the Prometheus text exposition format.
+    """
+    families = [
+        (
+            'django_agent_trust_outcomes_total',
+            'Agents loaded from cookies, by outcome.',
+            'outcome',
+            outcomes,
+        ),
+        (
+            'django_agent_trust_discards_total',
+            'Agent cookies discarded, by reason.',
+            'reason',
+            discards,
+        ),
+    ]
+
+    lines = []
+    for name, help_text, label, counters in families:
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} counter'.format(name))
+        for value, count in counters.snapshot().items():
+            lines.append('{0}{{{1}="{2}"}} {3}'.format(name, label, value, count))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _notify(name):
+    callback = conf.settings.AGENT_STATS_CALLBACK
+
+    if callback is not None:
+        if isinstance(callback, str):
+            callback = _import_callback(callback)
+
+        callback(name)
+
+
+@lru_cache(maxsize=None)
+def _import_callback(path):
+    return import_string(path)
@@ -0,0 +1,82 @@
+"""
+Optional per-phase timing of
+:class:`~django_agent_trust.middleware.AgentMiddleware`.
+
+When :setting:`AGENT_TIMING` or :setting:`AGENT_SERVER_TIMING` is enabled, the
+middleware collects the time spent in each phase of a request into a
+:class:`Timings` object held in a context variable. Code on the hot path times
+itself with :func:`phase`, which is a shared no-op when timing is disabled.
+"""
+
+from contextlib import nullcontext
+from contextvars import ContextVar
+from time import perf_counter
+
+
+#: Names of the phases that are timed.
+PHASES = ['settings', 'verify', 'decode', 'session', 'save']
+
+_current = ContextVar('django_agent_trust_timings', default=None)
+
+_NULL = nullcontext()
+
+
+class Timings(object):
+    """
+    Accumulates the seconds spent in each phase of one request.
+    """
+
+    __slots__ = ['phases']
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def server_timing(self):
+        """
+        Returns the phases formatted for a ``Server-Timing`` header.
+        """
+        return ', '.join(
+            'agent-{0};dur={1:.3f}'.format(name, seconds * 1000)
+            for name, seconds in self.phases.items()
+        )
+
+
+class _Phase(object):
+    __slots__ = ['timings', 'name', 'start']
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *args):
+        self.timings.add(self.name, perf_counter() - self.start)
+
+
+def start():
+    """
+    Starts collecting timings for the current context. Returns the new
+    :class:`Timings` and a token for :func:`stop`.
+    """
+    timings = Timings()
+
+    return timings, _current.set(timings)
+
+
+def stop(token):
+    _current.reset(token)
+
+
+def phase(name):
+    """
+    Returns a context manager that adds its duration to the named phase, if
+    timings are being collected.
+    """
+    timings = _current.get()
+
+    return _NULL if (timings is None) else _Phase(timings, name)
@@ -0,0 +1,16 @@
+from django.http import HttpResponse
+
+from . import stats
+from .decorators import agent_trust_exempt
+
+
+@agent_trust_exempt
+def metrics(request):
+    """
+    Serves this process's agent counters (see :mod:`django_agent_trust.stats`)
+    in the Prometheus text format. This view doesn't require authentication,
+    so you'll want to restrict access to it yourself.
+    """
+    return HttpResponse(
+        stats.prometheus_text(), content_type=stats.PROMETHEUS_CONTENT_TYPE
+    )
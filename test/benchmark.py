@@ -0,0 +1,333 @@
+"""
+Benchmarks for the AgentMiddleware hot path.
+
+This runs AgentMiddleware directly, with requests from RequestFactory, against
+the test project. Each scenario is run synchronously (as under WSGI) and
+asynchronously (as under ASGI). For each one we report requests per second and
+the mean latency of each phase:
+
+- request: The middleware's work before the view.
+- agent: Loading ``request.agent`` (forced by the view, or by process_view in
+  async mode).
+- response: The middleware's work after the view.
+
+A second pass under tracemalloc reports the peak memory allocated while
+handling each request and the number of allocations that survive it. This
+pass needs Python 3.9 or later and is skipped on older versions.
+
+Run it with ``hatch run bench`` or::
+
+    PYTHONPATH=test python -s test/benchmark.py --help
+
+"""
+
+from argparse import ArgumentParser
+from ast import literal_eval
+import asyncio
+from datetime import datetime, timedelta
+import os
+import sys
+from time import perf_counter
+import tracemalloc
+
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_project.settings')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import django  # noqa: E402
+
+
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.contrib.auth.models import AnonymousUser  # noqa: E402
+from django.contrib.sessions.backends.db import SessionStore  # noqa: E402
+from django.core import signing  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test.client import AsyncRequestFactory, RequestFactory  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+
+from django_agent_trust.conf import settings  # noqa: E402
+from django_agent_trust.middleware import AgentMiddleware  # noqa: E402
+from django_agent_trust.models import (  # noqa: E402
+    SESSION_TOKEN_KEY,
+    Agent,
+    AgentSettings,
+)
+
+
+SCENARIOS = [
+    'anonymous',
+    'no-cookie',
+    'trusted',
+    'session',
+    'expired',
+    'revoked',
+]
+
+PHASES = ['request', 'agent', 'response']
+
+
+class Fixtures(object):
+    """
+    Users and cookies for each scenario.
+    """
+
+    def __init__(self):
+        User = get_user_model()
+
+        self.alice = User.objects.create_user('alice')
+        self.mallory = User.objects.create_user('mallory')
+
+        self.token = 1234
+
+        now = datetime.now()
+        self.cookies = {
+            'trusted': self._cookie(Agent(self.alice, True, now, None, 0, None)),
+            'session': self._cookie(Agent(self.alice, True, now, None, 0, self.token)),
+            'expired': self._cookie(
+                Agent(self.alice, True, now - timedelta(days=30), 1, 0, None)
+            ),
+            'revoked': self._cookie(Agent(self.mallory, True, now, None, 0, None)),
+        }
+
+        AgentSettings.objects.filter(user=self.mallory).update(serial=1)
+
+    def request(self, factory, scenario):
+        """
+        Returns a fresh request for a scenario, as AuthenticationMiddleware
+        and SessionMiddleware would leave it.
+        """
+        request = factory.get('/')
+        request.session = SessionStore()
+
+        if scenario == 'anonymous':
+            request.user = AnonymousUser()
+        else:
+            user = self.mallory if (scenario == 'revoked') else self.alice
+
+            # A new instance, so that nothing is cached on it.
+            request.user = get_user_model().objects.get(pk=user.pk)
+
+        if scenario == 'session':
+            request.session[SESSION_TOKEN_KEY] = self.token
+
+        if scenario in self.cookies:
+            request.COOKIES.update([self.cookies[scenario]])
+
+        return request
+
+    def _cookie(self, agent):
+        cookie_name = AgentMiddleware._cookie_name(agent.user.get_username())
+        encoded = AgentMiddleware()._encode_cookie(agent, agent.user)
+        signed = signing.get_cookie_signer(salt=cookie_name).sign(encoded)
+
+        return cookie_name, signed
+
+
+class Timer(object):
+    """
+    Accumulates per-phase timings.
+    """
+
+    def __init__(self):
+        self.totals = dict((phase, 0.0) for phase in PHASES)
+        self.count = 0
+        self.marks = {}
+
+    def mark(self, name):
+        self.marks[name] = perf_counter()
+
+    def record(self):
+        m = self.marks
+        self.totals['request'] += m['view'] - m['start']
+        self.totals['agent'] += m['agent'] - m['view']
+        self.totals['response'] += m['end'] - m['done']
+        self.count += 1
+
+    @property
+    def elapsed(self):
+        return sum(self.totals.values())
+
+
+def run_sync(fixtures, scenario, iterations, timer=None):
+    def view(request):
+        timer.mark('view')
+        request.agent.is_trusted
+        timer.mark('agent')
+        response = HttpResponse()
+        timer.mark('done')
+
+        return response
+
+    timer = timer or Timer()
+    middleware = AgentMiddleware(view)
+    factory = RequestFactory()
+
+    for _ in range(iterations):
+        request = fixtures.request(factory, scenario)
+
+        timer.mark('start')
+        middleware(request)
+        timer.mark('end')
+        timer.record()
+
+    return timer
+
+
+async def run_async(fixtures, scenario, iterations, timer=None):
+    async def get_response(request):
+        timer.mark('view')
+        await middleware.process_view(request, view, (), {})
+        request.agent.is_trusted
+        timer.mark('agent')
+
+        return await view(request)
+
+    async def view(request):
+        response = HttpResponse()
+        timer.mark('done')
+
+        return response
+
+    timer = timer or Timer()
+    middleware = AgentMiddleware(get_response)
+    factory = AsyncRequestFactory()
+
+    for _ in range(iterations):
+        request = await _arequest(fixtures, factory, scenario)
+
+        timer.mark('start')
+        await middleware(request)
+        timer.mark('end')
+        timer.record()
+
+    return timer
+
+
+async def _arequest(fixtures, factory, scenario):
+    from asgiref.sync import sync_to_async
+
+    return await sync_to_async(fixtures.request)(factory, scenario)
+
+
+def measure_allocations(fixtures, scenario, mode, iterations):
+    """
+    Returns the mean peak and retained bytes per request.
+    """
+
+    class AllocationTimer(Timer):
+        def mark(self, name):
+            if name == 'start':
+                self.before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            elif name == 'end':
+                current, peak = tracemalloc.get_traced_memory()
+                self.peak += peak - self.before
+                self.retained += current - self.before
+
+            super().mark(name)
+
+    timer = AllocationTimer()
+    timer.peak = timer.retained = 0
+
+    tracemalloc.start()
+    try:
+        if mode == 'sync':
+            run_sync(fixtures, scenario, iterations, timer)
+        else:
+            asyncio.run(run_async(fixtures, scenario, iterations, timer))
+    finally:
+        tracemalloc.stop()
+
+    return timer.peak / timer.count, timer.retained / timer.count
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark AgentMiddleware.")
+    parser.add_argument(
+        '-n', '--iterations', type=int, default=2000, help="Requests per scenario."
+    )
+    parser.add_argument(
+        '--scenario', action='append', choices=SCENARIOS, help="Limit scenarios."
+    )
+    parser.add_argument(
+        '--mode', action='append', choices=['sync', 'async'], help="Limit modes."
+    )
+    parser.add_argument(
+        '-s',
+        '--setting',
+        action='append',
+        default=[],
+        metavar='NAME=VALUE',
+        help="Override an agent trust setting. VALUE is a Python literal.",
+    )
+    parser.add_argument(
+        '--no-alloc', action='store_true', help="Skip the allocation pass."
+    )
+    args = parser.parse_args(argv)
+
+    if not (args.no_alloc or hasattr(tracemalloc, 'reset_peak')):
+        print("Skipping the allocation pass, which needs Python 3.9.", file=sys.stderr)
+        args.no_alloc = True
+
+    overrides = {}
+    for setting in args.setting:
+        name, value = setting.split('=', 1)
+        overrides[name] = literal_eval(value)
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    fixtures = Fixtures()
+    scenarios = args.scenario or SCENARIOS
+    modes = args.mode or ['sync', 'async']
+    warmup = max(args.iterations // 10, 1)
+
+    print(
+        '{:<10} {:<6} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'scenario',
+            'mode',
+            'req/s',
+            'request us',
+            'agent us',
+            'resp us',
+            'peak KiB',
+            'kept B',
+        )
+    )
+
+    with settings(**overrides):
+        for scenario in scenarios:
+            for mode in modes:
+                if mode == 'sync':
+                    run_sync(fixtures, scenario, warmup)
+                    timer = run_sync(fixtures, scenario, args.iterations)
+                else:
+                    asyncio.run(run_async(fixtures, scenario, warmup))
+                    timer = asyncio.run(run_async(fixtures, scenario, args.iterations))
+
+                if args.no_alloc:
+                    peak = retained = float('nan')
+                else:
+                    peak, retained = measure_allocations(
+                        fixtures, scenario, mode, warmup
+                    )
+
+                print(
+                    '{:<10} {:<6} {:>9.0f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.0f}'.format(
+                        scenario,
+                        mode,
+                        timer.count / timer.elapsed,
+                        timer.totals['request'] / timer.count * 1e6,
+                        timer.totals['agent'] / timer.count * 1e6,
+                        timer.totals['response'] / timer.count * 1e6,
+                        peak / 1024,
+                        retained,
+                    )
+                )
+
+
+if __name__ == '__main__':
+    main()
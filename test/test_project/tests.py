@@ -1,17 +1,56 @@
 from datetime import datetime, timedelta
+from io import StringIO
+import time
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
-from django.db import IntegrityError
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
 from django.http import HttpResponse
-from django.test import TestCase
-from django.test.client import Client, RequestFactory
-
+from django.test import TestCase, override_settings
+from django.test.client import (
+    AsyncClient,
+    AsyncRequestFactory,
+    Client,
+    RequestFactory,
+)
+from django.test.utils import CaptureQueriesContext
+from django.views.generic.base import View
+
+from django_agent_trust import (
+    cache,
+    codec,
+    conf,
+    revocation,
+    revoke_all_agents,
+    stats,
+    timing,
+)
+from django_agent_trust.backends import AgentSettingsModelBackend
+from django_agent_trust.cache import LRUCache
 from django_agent_trust.conf import settings
-from django_agent_trust.decorators import trusted_agent_required
-from django_agent_trust.middleware import AgentMiddleware
-from django_agent_trust.models import Agent, AgentSettings
+from django_agent_trust.decorators import (
+    TrustedAgentRequiredMixin,
+    agent_trust_exempt,
+    trusted_agent_required,
+)
+from django_agent_trust.middleware import EXEMPT_AGENT, AgentMiddleware, CookieAction
+from django_agent_trust.models import (
+    SESSION_TOKEN_KEY,
+    Agent,
+    AgentSettings,
+    RevokedAgent,
+    settings_stamp,
+)
+from django_agent_trust.revocation import denylist
+from django_agent_trust.signals import agent_timing
+from django_agent_trust.views import metrics
 
 
 def now():
@@ -152,6 +191,37 @@ class AgentCodingTestCase(AgentTrustTestCase):
         self.assertTrue(agent.is_trusted)
         self.assertTrue(agent.is_session)
 
+    def test_refresh_default(self):
+        agent = self._roundtrip(True, now(), None, 1, None)
+
+        self.assertEqual(self._cookie_action(agent), CookieAction.SAVE)
+
+    def test_refresh_recent(self):
+        agent = self._roundtrip(True, now(), None, 1, None)
+
+        with settings(AGENT_COOKIE_REFRESH_FRACTION=0.1):
+            action = self._cookie_action(agent)
+
+        self.assertIsNotNone(agent.refreshed_at)
+        self.assertEqual(action, CookieAction.NONE)
+
+    def test_refresh_stale(self):
+        refreshed_at = now() - timedelta(days=40)
+        agent = Agent(self.alice, True, now(), None, 1, None, refreshed_at)
+
+        with settings(AGENT_COOKIE_REFRESH_FRACTION=0.1):
+            action = self._cookie_action(agent)
+
+        self.assertEqual(action, CookieAction.SAVE)
+
+    def test_refresh_new(self):
+        agent = Agent.trusted_agent(self.alice)
+
+        with settings(AGENT_COOKIE_REFRESH_FRACTION=0.1):
+            action = self._cookie_action(agent)
+
+        self.assertEqual(action, CookieAction.SAVE)
+
     def test_cross_user(self):
         AgentSettings.objects.get_or_create(user=self.bob)
 
@@ -161,11 +231,278 @@ class AgentCodingTestCase(AgentTrustTestCase):
 
         self.assertTrue(not agent.is_trusted)
 
+    def test_compact(self):
+        trusted_at = now()
+        agent = Agent(self.alice, True, trusted_at, 5.5, 3, 1234)
+        json_encoded = self._encode_cookie(agent)
+
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            encoded = self._encode_cookie(agent)
+            agent = self._decode_cookie(encoded)
+
+        self.assertLess(len(encoded), len(json_encoded) / 3)
+        self.assertTrue(agent.is_trusted)
+        self.assertEqual(agent.trusted_at, trusted_at)
+        self.assertEqual(agent.trust_days, 5.5)
+        self.assertEqual(agent.serial, 3)
+        self.assertEqual(agent.session, 1234)
+        self.assertIsNotNone(agent.refreshed_at)
+
+    def test_compact_unknown_version(self):
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            encoded = self._encode_cookie(Agent.trusted_agent(self.alice))
+
+        # Version 1 starts with 'A'.
+        self.assertEqual(encoded[0], 'A')
+        self.assertEqual(codec.decode('B' + encoded[1:]), {})
+
+    def test_compact_untrusted(self):
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            agent = self._roundtrip_agent(Agent.untrusted_agent(self.alice))
+
+        self.assertTrue(not agent.is_trusted)
+        self.assertEqual(agent.trusted_at, None)
+        self.assertEqual(agent.trust_days, None)
+        self.assertEqual(agent.session, None)
+
+    def test_compact_cross_user(self):
+        agent = Agent.trusted_agent(self.alice)
+
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            encoded = self.middleware._encode_cookie(agent, self.alice)
+            agent = self.middleware._decode_cookie(encoded, self.bob)
+
+        self.assertTrue(not agent.is_trusted)
+
+    def test_compact_reads_json(self):
+        encoded = self._encode_cookie(Agent.trusted_agent(self.alice))
+
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            agent = self._decode_cookie(encoded)
+
+        self.assertTrue(agent.is_trusted)
+
+    def test_compact_fallback(self):
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            agent = self._roundtrip(True, now(), None, 1, '1234')
+
+        self.assertTrue(agent.is_trusted)
+        self.assertEqual(agent.session, '1234')
+
+    def test_bad_signature(self):
+        cookie_name = AgentMiddleware._cookie_name('alice')
+        signed = self._sign_cookie(Agent.trusted_agent(self.alice))
+
+        data = self.middleware._verify_cookie(signed + 'x', cookie_name, 3600)
+
+        self.assertEqual(data, {})
+
+    def test_payload_cache(self):
+        cookie_name = AgentMiddleware._cookie_name('alice')
+        signed = self._sign_cookie(Agent.trusted_agent(self.alice))
+
+        with settings(AGENT_COOKIE_CACHE_SIZE=10):
+            middleware = AgentMiddleware()
+
+        data1 = middleware._verify_cookie(signed, cookie_name, 3600)
+        data2 = middleware._verify_cookie(signed, cookie_name, 3600)
+
+        self.assertTrue(data1['is_trusted'])
+        self.assertIs(data1, data2)
+        self.assertEqual(len(middleware.payload_cache), 1)
+
+    def test_payload_cache_expired(self):
+        cookie_name = AgentMiddleware._cookie_name('alice')
+        signed = self._sign_cookie(Agent.trusted_agent(self.alice))
+
+        with settings(AGENT_COOKIE_CACHE_SIZE=10):
+            middleware = AgentMiddleware()
+
+        data = middleware._verify_cookie(signed, cookie_name, 3600)
+        middleware.payload_cache.set(
+            (cookie_name, signed, 3600), (data, time.time() - 7200)
+        )
+
+        self.assertEqual(middleware._verify_cookie(signed, cookie_name, 3600), {})
+
+    def test_payload_cache_eviction(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_agent_immutable(self):
+        agent = Agent.trusted_agent(self.alice)
+
+        self.assertFalse(hasattr(agent, '__dict__'))
+        with self.assertRaises(AttributeError):
+            agent._serial = 5
+
+    def test_agent_replace(self):
+        agent = Agent.trusted_agent(self.alice)
+        replaced = agent._replace(serial=5)
+
+        self.assertEqual(replaced.serial, 5)
+        self.assertEqual(replaced.agent_id, agent.agent_id)
+        self.assertEqual(agent.serial, 0)
+
+    def test_anonymous_singleton(self):
+        agent1 = Agent.untrusted_agent(AnonymousUser())
+        agent2 = Agent.untrusted_agent(AnonymousUser())
+
+        self.assertIs(agent1, agent2)
+        self.assertIsNot(agent1, EXEMPT_AGENT)
+
+    def test_anonymous_cookie_action(self):
+        calls = []
+
+        class Middleware(AgentMiddleware):
+            def cookie_action(self, request, response, agent):
+                calls.append(agent)
+
+                return super().cookie_action(request, response, agent)
+
+        def get_response(request):
+            return HttpResponse(str(request.agent.is_trusted))
+
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        Middleware(get_response)(request)
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(calls[0].user.is_anonymous)
+
+    def test_username_cached(self):
+        User = get_user_model()
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=self.alice.pk)
+        request.session = {}
+        request.COOKIES[AgentMiddleware._cookie_name('alice')] = self._sign_cookie(
+            Agent.trusted_agent(self.alice)
+        )
+
+        with patch.object(
+            User, 'get_username', autospec=True, side_effect=User.get_username
+        ) as get_username:
+            agent = self.middleware._get_agent(request)
+            self.middleware._encode_cookie(agent, agent.user)
+
+        self.assertTrue(agent.is_trusted)
+        self.assertEqual(get_username.call_count, 1)
+
+    def test_expires_stamped(self):
+        agent = Agent(self.alice, True, now(), 2, 0, None)
+        data = self.middleware._decode_payload(self._encode_cookie(agent))
+
+        self.assertEqual(
+            datetime.fromtimestamp(data['expires']), agent.trusted_at + timedelta(days=2)
+        )
+        self.assertEqual(data['stamp'], settings_stamp(self.agentsettings))
+
+    def test_expires_rejected_early(self):
+        agent = Agent(self.alice, True, now() - timedelta(days=3), 2, 0, None)
+        request = RequestFactory().get('/')
+        request.COOKIES[AgentMiddleware._cookie_name('alice')] = self._sign_cookie(agent)
+        user = get_user_model().objects.get(pk=self.alice.pk)
+
+        with self.assertNumQueries(0):
+            agent, reason = self.middleware._read_agent(request, user)
+
+        self.assertTrue(not agent.is_trusted)
+        self.assertEqual(reason, 'expired')
+
+    def test_expires_precomputed(self):
+        data = Agent(self.alice, True, now(), 2, 0, None).to_jsonable()
+        data['trusted_at'] -= 3 * 86400
+
+        # The stamp matches, so the expiration isn't recomputed.
+        agent = Agent.from_jsonable(data, self.alice)
+
+        self.assertTrue(not self.middleware._should_discard_agent(agent))
+
+    def test_expires_recomputed(self):
+        agent = Agent(self.alice, True, now() - timedelta(days=3), None, 0, None)
+        encoded = self._encode_cookie(agent)
+
+        self.agentsettings.trust_days = 1
+        self.agentsettings.save()
+
+        agent = self._decode_cookie(encoded)
+
+        self.assertTrue(not agent.is_trusted)
+
+    def test_expires_compact(self):
+        agent = Agent(self.alice, True, now(), 2, 0, None)
+
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            decoded = self._roundtrip_agent(agent)
+
+        self.assertEqual(decoded.trust_expiration, agent.trust_expiration)
+        self.assertEqual(decoded._stamp, agent._stamp)
+
+    def test_create_race(self):
+        # Another request created the settings first. The failed INSERT must
+        # not break the enclosing transaction, so it has to run in a savepoint.
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                agentsettings = AgentSettings.objects._create_for_user(self.alice)
+
+            # The transaction is still usable.
+            pk = AgentSettings.objects.get(user=self.alice).pk
+
+        sql = [query['sql'].upper() for query in queries]
+        self.assertTrue(any(q.startswith('SAVEPOINT') for q in sql))
+        self.assertTrue(any(q.startswith('ROLLBACK TO SAVEPOINT') for q in sql))
+        self.assertEqual(agentsettings.pk, pk)
+
+    def test_bump_serial(self):
+        agentsettings1 = AgentSettings.objects.get(user=self.alice)
+        agentsettings2 = AgentSettings.objects.get(user=self.alice)
+        agentsettings1.trust_days = 7
+
+        agentsettings1.bump_serial()
+        agentsettings2.bump_serial()
+        agentsettings = AgentSettings.objects.get(user=self.alice)
+
+        self.assertEqual(agentsettings1.serial, 1)
+        self.assertEqual(agentsettings2.serial, 2)
+        self.assertEqual(agentsettings.serial, 2)
+        self.assertIsNone(agentsettings.trust_days)
+
     def test_inactivity_config(self):
         with self.assertRaises(ImproperlyConfigured):
             with settings(AGENT_INACTIVITY_DAYS=()):
                 self.middleware._max_cookie_age(self.agentsettings)
 
+    def test_settings_immutable(self):
+        with self.assertRaises(AttributeError):
+            conf.settings.AGENT_TRUST_DAYS = 1
+
+    def test_settings_derived(self):
+        with settings(AGENT_INACTIVITY_DAYS=2, AGENT_COOKIE_SECURE=True):
+            self.assertEqual(conf.settings.max_cookie_age, 2 * 86400)
+            self.assertTrue(conf.settings.cookie_kwargs['secure'])
+
+        self.assertEqual(conf.settings.max_cookie_age, 365 * 86400)
+
+    @override_settings(AGENT_COOKIE_NAME='custom-trust', LOGIN_URL='/custom/')
+    def test_settings_changed(self):
+        self.assertEqual(conf.settings.AGENT_COOKIE_NAME, 'custom-trust')
+        self.assertEqual(conf.settings.AGENT_LOGIN_URL, '/custom/')
+        self.assertTrue(AgentMiddleware._cookie_name('alice').startswith('custom-trust-'))
+
+    def test_settings_invalid(self):
+        with self.assertRaises(ImproperlyConfigured):
+            with override_settings(AGENT_COOKIE_FORMAT='bogus'):
+                pass
+
+        self.assertEqual(conf.settings.AGENT_COOKIE_FORMAT, 'json')
+
     def test_inactivity_precedence(self):
         self.agentsettings.inactivity_days = 30
 
@@ -186,217 +523,1455 @@ class AgentCodingTestCase(AgentTrustTestCase):
     def _encode_cookie(self, agent):
         return self.middleware._encode_cookie(agent, self.alice)
 
+    def _cookie_action(self, agent):
+        return self.middleware.cookie_action(None, None, agent)
+
     def _decode_cookie(self, encoded):
         return self.middleware._decode_cookie(encoded, self.alice)
 
+    def _sign_cookie(self, agent):
+        cookie_name = AgentMiddleware._cookie_name(self.alice.get_username())
+        signer = signing.get_cookie_signer(salt=cookie_name)
 
-class DecoratorTest(AgentTrustTestCase):
+        return signer.sign(self._encode_cookie(agent))
+
+
+class AgentSettingsCacheTestCase(AgentTrustTestCase):
     def setUp(self):
-        try:
-            self.alice = self.create_user('alice', 'alice')
-        except IntegrityError:
-            self.skipTest("Unable to create a test user.")
+        self.alice = self.create_user('alice', 'alice')
 
-        self.factory = RequestFactory()
+        caches['default'].clear()
 
-    def test_view_1_untrusted(self):
-        request = self.factory.get('/')
-        request.user = self.alice
-        request.agent = Agent.untrusted_agent(self.alice)
+    def test_disabled(self):
+        self._load_settings()
+        self._load_settings(num_queries=1)
 
-        response = decorated_view_1(request)
+    def test_cached(self):
+        with settings(AGENT_SETTINGS_CACHE='default'):
+            self._load_settings()
+            agentsettings = self._load_settings(num_queries=0)
 
-        self.assertEqual(response.status_code, 302)
+        self.assertEqual(agentsettings.pk, self.alice.agentsettings.pk)
+        self.assertEqual(agentsettings.serial, 0)
 
-    def test_view_1_trusted(self):
-        request = self.factory.get('/')
-        request.user = self.alice
-        request.agent = Agent.trusted_agent(self.alice)
+    def test_invalidate_save(self):
+        with settings(AGENT_SETTINGS_CACHE='default'):
+            agentsettings = self._load_settings()
+            agentsettings.trust_days = 5
+            agentsettings.save()
+            agentsettings = self._load_settings(num_queries=1)
 
-        response = decorated_view_1(request)
+        self.assertEqual(agentsettings.trust_days, 5)
 
-        self.assertEqual(response.status_code, 200)
+    def test_invalidate_delete(self):
+        with settings(AGENT_SETTINGS_CACHE='default'):
+            self._load_settings().delete()
 
-    def test_view_2_untrusted(self):
-        request = self.factory.get('/')
-        request.user = self.alice
-        request.agent = Agent.untrusted_agent(self.alice)
+            agentsettings = self._load_settings()
 
-        response = decorated_view_2(request)
+        self.assertIsNone(agentsettings.trust_days)
+        self.assertEqual(AgentSettings.objects.filter(user=self.alice).count(), 1)
 
-        self.assertEqual(response.status_code, 302)
+    def test_stale_write(self):
+        with settings(AGENT_SETTINGS_CACHE='default'):
+            # A request captures the version and reads the row...
+            _, version = cache.get_agentsettings(AgentSettings, self.alice)
+            stale = AgentSettings.objects.get(user=self.alice)
 
-    def test_view_2_trusted(self):
-        request = self.factory.get('/')
-        request.user = self.alice
-        request.agent = Agent.trusted_agent(self.alice)
+            # ...another request revokes the user's agents...
+            with self.captureOnCommitCallbacks(execute=True):
+                AgentSettings.objects.get(user=self.alice).bump_serial()
 
-        response = decorated_view_2(request)
+            # ...and the first request caches what it read.
+            cache.set_agentsettings(stale, version)
 
-        self.assertEqual(response.status_code, 200)
+            agentsettings = self._load_settings(num_queries=1)
 
+        self.assertEqual(agentsettings.serial, 1)
 
-@trusted_agent_required
-def decorated_view_1(request):
-    return HttpResponse()
+    def _load_settings(self, num_queries=None):
+        user = get_user_model().objects.get(pk=self.alice.pk)
 
+        if num_queries is not None:
+            with self.assertNumQueries(num_queries):
+                AgentSettings.objects.ensure_for_user(user)
+        else:
+            AgentSettings.objects.ensure_for_user(user)
 
-@trusted_agent_required()
-def decorated_view_2(request):
-    return HttpResponse()
+        return user.agentsettings
 
 
-class HttpTestCase(AgentTrustTestCase):
-    """
-    Tests that exercise the full request/response cycle. These are less
-    precise, but touch more code.
-    """
+class SparseTestCase(AgentTrustTestCase):
     def setUp(self):
-        try:
-            self.create_user('alice', 'alice')
-            self.create_user('bob', 'bob')
-        except IntegrityError:
-            self.skipTest("Unable to create a test user.")
-        else:
-            self.alice = AgentClient('alice')
-            self.bob = AgentClient('bob')
+        with settings(AGENT_SETTINGS_SPARSE=True):
+            self.alice = self.create_user('alice', 'alice')
 
-    def test_anonymous(self):
-        response = self.alice.get_restricted()
+        caches['default'].clear()
 
-        self.assertEqual(response.status_code, 302)
+    def test_no_row(self):
+        with settings(AGENT_SETTINGS_SPARSE=True):
+            AgentSettings.objects.ensure_for_user(self.alice)
 
-    def test_anon_trust(self):
-        self.alice.trust()
-        response = self.alice.get_restricted()
+        self.assertIsNone(self.alice.agentsettings.pk)
+        self.assertEqual(self.alice.agentsettings.serial, 0)
+        self.assertFalse(AgentSettings.objects.exists())
 
-        self.assertEqual(response.status_code, 302)
+    def test_cached_default(self):
+        with settings(AGENT_SETTINGS_SPARSE=True, AGENT_SETTINGS_CACHE='default'):
+            AgentSettings.objects.ensure_for_user(self._fresh_user())
+            user = self._fresh_user()
 
-    def test_authenticated(self):
-        self.alice.login()
-        response = self.alice.get_restricted()
+            with self.assertNumQueries(0):
+                AgentSettings.objects.ensure_for_user(user)
 
-        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(user.agentsettings.pk)
 
-    def test_trusted(self):
-        self.alice.login()
-        self.alice.trust()
-        response = self.alice.get_restricted()
+    def test_customize(self):
+        with settings(AGENT_SETTINGS_SPARSE=True):
+            AgentSettings.objects.ensure_for_user(self.alice)
+            self.alice.agentsettings.trust_days = 5
+            self.alice.agentsettings.save()
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AgentSettings.objects.get(user=self.alice).trust_days, 5)
 
-    def test_anon(self):
-        self.alice.trust()
-        response = self.alice.get_restricted()
+    def test_bump_serial(self):
+        with settings(AGENT_SETTINGS_SPARSE=True, AGENT_SETTINGS_CACHE='default'):
+            AgentSettings.objects.ensure_for_user(self._fresh_user())
+            user = self._fresh_user()
+            AgentSettings.objects.ensure_for_user(user)
+            user.agentsettings.bump_serial()
 
-        self.assertEqual(response.status_code, 302)
+            user = self._fresh_user()
+            AgentSettings.objects.ensure_for_user(user)
 
-    def test_revoked(self):
-        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+        self.assertEqual(user.agentsettings.serial, 1)
+        self.assertEqual(AgentSettings.objects.get(user=self.alice).serial, 1)
 
-        self.alice.login()
-        self.alice.trust()
-        response = self.alice.revoke()
+    def test_trust(self):
+        alice = AgentClient('alice')
 
-        self.assertEqual(response.cookies[cookie_name]['max-age'], 0)
+        with settings(AGENT_SETTINGS_SPARSE=True):
+            alice.login()
+            alice.trust()
+            response = alice.get_restricted()
 
-        response = self.alice.get_restricted()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(AgentSettings.objects.exists())
 
-        self.assertEqual(response.status_code, 302)
+    def test_revoke_others(self):
+        alice1 = AgentClient('alice')
+        alice2 = AgentClient('alice')
 
-    def test_exotic_username(self):
-        self.create_user('charlie@example.com', 'charlie')
-        charlie = AgentClient('charlie@example.com', 'charlie')
+        with settings(AGENT_SETTINGS_SPARSE=True):
+            alice1.login()
+            alice1.trust()
 
-        charlie.login()
-        charlie.trust()
-        response = charlie.get_restricted()
+            alice2.login()
+            alice2.trust()
+            alice2.revoke_others()
 
-        self.assertEqual(response.status_code, 200)
+            response1 = alice1.get_restricted()
+            response2 = alice2.get_restricted()
 
-    def test_persist(self):
-        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+        self.assertEqual(response1.status_code, 302)
+        self.assertEqual(response2.status_code, 200)
 
-        self.alice.login()
-        response = self.alice.trust()
+    def _fresh_user(self):
+        return get_user_model().objects.get(pk=self.alice.pk)
 
-        self.assertGreater(response.cookies[cookie_name]['max-age'], 0)
 
-        self.alice.logout()
-        self.alice.login()
-        response = self.alice.get_restricted()
+class BackendTestCase(AgentTrustTestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice', 'alice')
+        self.backend = AgentSettingsModelBackend()
 
-        self.assertEqual(response.status_code, 200)
+    def test_get_user(self):
+        user = self.backend.get_user(self.alice.pk)
 
-    def test_trusted_session(self):
-        self.alice.login()
-        self.alice.trust_session()
-        response = self.alice.get_restricted()
+        with self.assertNumQueries(0):
+            AgentSettings.objects.ensure_for_user(user)
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user.agentsettings.pk, self.alice.agentsettings.pk)
 
-    def test_old_session(self):
-        self.alice.login()
-        self.alice.trust_session()
-        self.alice.logout()
-        self.alice.login()
-        response = self.alice.get_restricted()
+    def test_get_user_missing_settings(self):
+        AgentSettings.objects.all().delete()
+        user = self.backend.get_user(self.alice.pk)
 
-        self.assertEqual(response.status_code, 302)
+        AgentSettings.objects.ensure_for_user(user)
 
-    def test_anon_session(self):
-        self.alice.trust_session()
-        response = self.alice.get_restricted()
+        self.assertIsNotNone(user.agentsettings.pk)
 
-        self.assertEqual(response.status_code, 302)
+    def test_get_user_missing(self):
+        self.assertIsNone(self.backend.get_user(0))
 
-    def test_replace_trust(self):
-        self.alice.login()
-        self.alice.trust()
-        self.alice.trust_session()
-        self.alice.logout()
-        self.alice.login()
-        response = self.alice.get_restricted()
+    @override_settings(
+        AUTHENTICATION_BACKENDS=['django_agent_trust.backends.AgentSettingsModelBackend']
+    )
+    def test_request(self):
+        client = AgentClient('alice')
+        client.login()
+        client.trust()
+        denylist.refresh()
 
-        self.assertEqual(response.status_code, 302)
+        # Session and user.
+        with self.assertNumQueries(2):
+            response = client.get_restricted()
 
-    def test_other_trusted(self):
-        self.alice.login()
-        self.alice.trust()
-        self.alice.logout()
+        self.assertEqual(response.status_code, 200)
 
-        self.bob.login()
-        response = self.bob.get_restricted()
 
-        self.assertEqual(response.status_code, 302)
+class BulkTestCase(AgentTrustTestCase):
+    def setUp(self):
+        self.users = [
+            self.create_user(username, username)
+            for username in ['alice', 'bob', 'charlie']
+        ]
 
-    def test_other_revoked(self):
-        self.alice.login()
-        self.alice.trust()
+        AgentSettings.objects.filter(user=self.users[1]).delete()
 
-        self.bob.login()
-        self.bob.trust()
-        self.bob.revoke()
-        self.bob.logout()
+    def test_bump_serials(self):
+        progress = []
 
-        response = self.alice.get_restricted()
+        count = AgentSettings.objects.bump_serials(
+            batch_size=2, progress=lambda *args: progress.append(args)
+        )
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(count, 3)
+        self.assertEqual(self._serials(), [1, 1, 1])
+        self.assertEqual(progress, [(2, self.users[1].pk), (3, self.users[2].pk)])
 
-    def test_revoke_others(self):
-        alice1 = AgentClient('alice')
-        alice2 = AgentClient('alice')
+    def test_bump_serials_queryset(self):
+        users = get_user_model().objects.filter(username__in=['alice', 'charlie'])
 
-        alice1.login()
-        alice1.trust()
+        AgentSettings.objects.bump_serials(users)
 
-        alice2.login()
-        alice2.trust()
-        alice2.revoke_others()
+        self.assertEqual(self._serials(), [1, None, 1])
 
-        response = alice1.get_restricted()
+    def test_bump_serials_resume(self):
+        AgentSettings.objects.bump_serials(start_after=self.users[0].pk)
 
-        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self._serials(), [0, 1, 1])
+
+    def test_command(self):
+        out = StringIO()
+
+        call_command('revoke_agents', '--user', 'bob', stdout=out)
+
+        self.assertEqual(self._serials(), [0, 1, 0])
+        self.assertIn('Revoked agents for 1 users', out.getvalue())
+
+    def test_command_filter(self):
+        call_command('revoke_agents', '--filter', 'username__startswith=c', verbosity=0)
+
+        self.assertEqual(self._serials(), [0, None, 1])
+
+    def test_command_all(self):
+        call_command('revoke_agents', '--all', '--batch-size', '1', verbosity=0)
+
+        self.assertEqual(self._serials(), [1, 1, 1])
+
+    def test_command_no_users(self):
+        with self.assertRaises(CommandError):
+            call_command('revoke_agents', verbosity=0)
+
+    def test_command_bad_filter(self):
+        with self.assertRaises(CommandError):
+            call_command('revoke_agents', '--filter', 'bogus=1', verbosity=0)
+
+    def test_backfill(self):
+        AgentSettings.objects.filter(user=self.users[2]).delete()
+        progress = []
+
+        count = AgentSettings.objects.backfill(
+            batch_size=1, progress=lambda *args: progress.append(args)
+        )
+
+        self.assertEqual(count, 2)
+        self.assertEqual(self._serials(), [0, 0, 0])
+        self.assertEqual(progress, [(1, self.users[1].pk), (2, self.users[2].pk)])
+
+    def test_backfill_command(self):
+        out = StringIO()
+
+        call_command('backfill_agentsettings', stdout=out)
+
+        self.assertEqual(self._serials(), [0, 0, 0])
+        self.assertIn('Created AgentSettings for 1 users', out.getvalue())
+
+    def _serials(self):
+        serials = dict(AgentSettings.objects.values_list('user_id', 'serial'))
+
+        return [serials.get(user.pk) for user in self.users]
+
+
+class EpochTestCase(AgentTrustTestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice', 'alice')
+        self.middleware = AgentMiddleware()
+
+        caches['default'].clear()
+        revocation.reset()
+
+    def tearDown(self):
+        revocation.reset()
+
+    def test_default(self):
+        agent = Agent.trusted_agent(self.alice)
+
+        self.assertEqual(agent.epoch, 0)
+        self.assertTrue(self._roundtrip(agent).is_trusted)
+
+    def test_setting(self):
+        agent = Agent.trusted_agent(self.alice)
+
+        with settings(AGENT_TRUST_EPOCH=1):
+            self.assertTrue(not self._roundtrip(agent).is_trusted)
+            self.assertTrue(self._roundtrip(Agent.trusted_agent(self.alice)).is_trusted)
+
+    def test_revoke_all(self):
+        with settings(AGENT_EPOCH_CACHE='default'):
+            agent = Agent.trusted_agent(self.alice)
+            epoch = revoke_all_agents()
+            new_agent = Agent.trusted_agent(self.alice)
+
+            self.assertEqual(epoch, 1)
+            self.assertTrue(not self._roundtrip(agent).is_trusted)
+            self.assertTrue(self._roundtrip(new_agent).is_trusted)
+
+    def test_revoke_all_compact(self):
+        with settings(AGENT_EPOCH_CACHE='default', AGENT_COOKIE_FORMAT='compact'):
+            agent = Agent.trusted_agent(self.alice)
+            revoke_all_agents()
+            new_agent = Agent.trusted_agent(self.alice)
+
+            self.assertTrue(not self._roundtrip(agent).is_trusted)
+            self.assertEqual(self._roundtrip(new_agent).epoch, 1)
+
+    def test_ttl(self):
+        with settings(AGENT_EPOCH_CACHE='default', AGENT_EPOCH_TTL=60):
+            agent = Agent.trusted_agent(self.alice)
+
+            # Another process advances the epoch.
+            caches['default'].set(revocation.EPOCH_KEY, 1, timeout=None)
+
+            self.assertTrue(self._roundtrip(agent).is_trusted)
+
+            revocation.reset()
+
+            self.assertTrue(not self._roundtrip(agent).is_trusted)
+
+    def test_not_configured(self):
+        with self.assertRaises(ImproperlyConfigured):
+            revoke_all_agents()
+
+    def test_command(self):
+        out = StringIO()
+
+        with settings(AGENT_EPOCH_CACHE='default'):
+            call_command('revoke_agents', '--epoch', stdout=out)
+
+            self.assertEqual(revocation.current_epoch(), 1)
+
+        self.assertIn('epoch 1', out.getvalue())
+
+    def test_command_not_configured(self):
+        with self.assertRaises(CommandError):
+            call_command('revoke_agents', '--epoch', verbosity=0)
+
+    def _roundtrip(self, agent):
+        encoded = self.middleware._encode_cookie(agent, self.alice)
+
+        return self.middleware._decode_cookie(encoded, self.alice)
+
+
+class DenylistTestCase(AgentTrustTestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice', 'alice')
+        self.middleware = AgentMiddleware()
+
+        denylist.reset()
+
+    def tearDown(self):
+        denylist.reset()
+
+    def test_agent_id(self):
+        agent1 = Agent.trusted_agent(self.alice)
+        agent2 = Agent.trusted_agent(self.alice)
+
+        self.assertIsNotNone(agent1.agent_id)
+        self.assertNotEqual(agent1.agent_id, agent2.agent_id)
+        self.assertIsNone(Agent.untrusted_agent(self.alice).agent_id)
+
+    def test_agent_id_roundtrip(self):
+        agent = Agent.trusted_agent(self.alice)
+
+        self.assertEqual(self._roundtrip(agent).agent_id, agent.agent_id)
+
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            self.assertEqual(self._roundtrip(agent).agent_id, agent.agent_id)
+
+    def test_revoke(self):
+        agent = Agent.trusted_agent(self.alice)
+        other = Agent.trusted_agent(self.alice)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            RevokedAgent.objects.revoke(self.alice, agent.agent_id)
+
+        self.assertTrue(not self._roundtrip(agent).is_trusted)
+        self.assertTrue(self._roundtrip(other).is_trusted)
+
+    def test_revoke_on_commit(self):
+        agent = Agent.trusted_agent(self.alice)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            RevokedAgent.objects.revoke(self.alice, agent.agent_id)
+
+        self.assertNotIn(agent.agent_id, denylist)
+
+        for callback in callbacks:
+            callback()
+
+        self.assertIn(agent.agent_id, denylist)
+
+    def test_refresh_once(self):
+        denylist.refresh()
+
+        # Threads that saw the denylist go stale wait for the first refresh
+        # and then skip their own.
+        with patch.object(denylist, 'is_stale', return_value=True):
+            with self.assertNumQueries(0):
+                denylist.refresh_if_stale()
+
+    def test_out_of_order(self):
+        # A row with a lower primary key becomes visible after a higher one.
+        RevokedAgent.objects.create(pk=100, user=self.alice, agent_id=1)
+        denylist.refresh()
+        RevokedAgent.objects.create(pk=50, user=self.alice, agent_id=2)
+        denylist.refresh()
+
+        self.assertIn(1, denylist)
+        self.assertIn(2, denylist)
+
+    def test_full_reload(self):
+        first = RevokedAgent.objects.create(user=self.alice, agent_id=1)
+        denylist.refresh()
+        # Committed too late for the overlap window.
+        RevokedAgent.objects.create(user=self.alice, agent_id=2)
+        RevokedAgent.objects.filter(agent_id=2).update(
+            revoked_at=first.revoked_at - timedelta(hours=1)
+        )
+
+        denylist.refresh()
+        self.assertNotIn(2, denylist)
+
+        denylist._reload_at = 0.0
+        denylist.refresh()
+        self.assertIn(2, denylist)
+
+    def test_legacy(self):
+        agent = Agent(self.alice, True, now(), None, 0, None)
+
+        self.assertTrue(self._roundtrip(agent).is_trusted)
+
+    def test_refresh(self):
+        agent1 = Agent.trusted_agent(self.alice)
+        agent2 = Agent.trusted_agent(self.alice)
+
+        # Revoked by other processes.
+        RevokedAgent.objects.create(user=self.alice, agent_id=agent1.agent_id)
+        denylist.refresh()
+        RevokedAgent.objects.create(user=self.alice, agent_id=agent2.agent_id)
+
+        with self.assertNumQueries(1):
+            denylist.refresh()
+        with self.assertNumQueries(0):
+            denylist.refresh_if_stale()
+
+        self.assertIn(agent1.agent_id, denylist)
+        self.assertIn(agent2.agent_id, denylist)
+        self.assertEqual(len(denylist), 2)
+
+    def test_request(self):
+        client = AgentClient('alice')
+        client.login()
+
+        agent_id = client.trust().wsgi_request.agent.agent_id
+        RevokedAgent.objects.create(
+            user=get_user_model().objects.get(username='alice'), agent_id=agent_id
+        )
+
+        with settings(AGENT_DENYLIST_TTL=0):
+            response = client.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def _roundtrip(self, agent):
+        encoded = self.middleware._encode_cookie(agent, self.alice)
+
+        return self.middleware._decode_cookie(encoded, self.alice)
+
+
+class DecoratorTest(AgentTrustTestCase):
+    def setUp(self):
+        try:
+            self.alice = self.create_user('alice', 'alice')
+        except IntegrityError:
+            self.skipTest("Unable to create a test user.")
+
+        self.factory = RequestFactory()
+
+    def test_view_1_untrusted(self):
+        request = self.factory.get('/')
+        request.user = self.alice
+        request.agent = Agent.untrusted_agent(self.alice)
+
+        response = decorated_view_1(request)
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_view_1_trusted(self):
+        request = self.factory.get('/')
+        request.user = self.alice
+        request.agent = Agent.trusted_agent(self.alice)
+
+        response = decorated_view_1(request)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_view_2_untrusted(self):
+        request = self.factory.get('/')
+        request.user = self.alice
+        request.agent = Agent.untrusted_agent(self.alice)
+
+        response = decorated_view_2(request)
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_view_2_trusted(self):
+        request = self.factory.get('/')
+        request.user = self.alice
+        request.agent = Agent.trusted_agent(self.alice)
+
+        response = decorated_view_2(request)
+
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_login_url(self):
+        request = self.factory.get('/restricted/?a=1')
+        request.agent = Agent.untrusted_agent(self.alice)
+
+        with settings(AGENT_LOGIN_URL='/trust-me/'):
+            response = decorated_view_1(request)
+
+        self.assertEqual(response.url, '/trust-me/?next=/restricted/%3Fa%3D1')
+
+    def test_async_untrusted(self):
+        request = self.factory.get('/')
+        request.agent = Agent.untrusted_agent(self.alice)
+
+        response = async_to_sync(async_decorated_view)(request)
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_async_trusted(self):
+        request = self.factory.get('/')
+        request.agent = Agent.trusted_agent(self.alice)
+
+        response = async_to_sync(async_decorated_view)(request)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_mixin_untrusted(self):
+        request = self.factory.get('/')
+        request.agent = Agent.untrusted_agent(self.alice)
+
+        response = MixinView.as_view()(request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith('/mixin-login/'))
+
+    def test_mixin_trusted(self):
+        request = self.factory.get('/')
+        request.agent = Agent.trusted_agent(self.alice)
+
+        response = MixinView.as_view()(request)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_async_mixin_untrusted(self):
+        request = self.factory.get('/')
+        request.agent = Agent.untrusted_agent(self.alice)
+
+        response = async_to_sync(AsyncMixinView.as_view())(request)
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_async_mixin_trusted(self):
+        request = self.factory.get('/')
+        request.agent = Agent.trusted_agent(self.alice)
+
+        response = async_to_sync(AsyncMixinView.as_view())(request)
+
+        self.assertEqual(response.status_code, 200)
+
+@trusted_agent_required
+def decorated_view_1(request):
+    return HttpResponse()
+
+
+@trusted_agent_required()
+def decorated_view_2(request):
+    return HttpResponse()
+
+
+@trusted_agent_required
+async def async_decorated_view(request):
+    return HttpResponse()
+
+
+class MixinView(TrustedAgentRequiredMixin, View):
+    agent_login_url = '/mixin-login/'
+
+    def get(self, request):
+        return HttpResponse()
+
+
+class AsyncMixinView(TrustedAgentRequiredMixin, View):
+    async def get(self, request):
+        return HttpResponse()
+
+
+class HttpTestCase(AgentTrustTestCase):
+    """
+    Tests that exercise the full request/response cycle. These are less
+    precise, but touch more code.
+    """
+    def setUp(self):
+        try:
+            self.create_user('alice', 'alice')
+            self.create_user('bob', 'bob')
+        except IntegrityError:
+            self.skipTest("Unable to create a test user.")
+        else:
+            self.alice = AgentClient('alice')
+            self.bob = AgentClient('bob')
+
+    def test_anonymous(self):
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_anon_trust(self):
+        self.alice.trust()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_authenticated(self):
+        self.alice.login()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_trusted(self):
+        self.alice.login()
+        self.alice.trust()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_async_view(self):
+        # The sync middleware has to load the agent for async views.
+        self.alice.login()
+        response1 = self.alice.get('/async-restricted/')
+        self.alice.trust()
+        response2 = self.alice.get('/async-restricted/')
+
+        self.assertEqual(response1.status_code, 302)
+        self.assertEqual(response2.status_code, 200)
+
+    def test_async_mixin_view(self):
+        self.alice.login()
+        response1 = self.alice.get('/async-mixin/')
+        self.alice.trust()
+        response2 = self.alice.get('/async-mixin/')
+
+        self.assertEqual(response1.status_code, 302)
+        self.assertEqual(response2.status_code, 200)
+
+    def test_no_cookie(self):
+        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+
+        self.alice.login()
+        self.alice.get_restricted()
+
+        # Session and user.
+        with self.assertNumQueries(2):
+            response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(cookie_name, response.cookies)
+
+    def test_no_cookie_trust(self):
+        AgentSettings.objects.all().delete()
+
+        self.alice.login()
+        self.alice.trust()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_anon(self):
+        self.alice.trust()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_revoked(self):
+        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+
+        self.alice.login()
+        self.alice.trust()
+        response = self.alice.revoke()
+
+        self.assertEqual(response.cookies[cookie_name]['max-age'], 0)
+
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_exotic_username(self):
+        self.create_user('charlie@example.com', 'charlie')
+        charlie = AgentClient('charlie@example.com', 'charlie')
+
+        charlie.login()
+        charlie.trust()
+        response = charlie.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_persist(self):
+        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+
+        self.alice.login()
+        response = self.alice.trust()
+
+        self.assertGreater(response.cookies[cookie_name]['max-age'], 0)
+
+        self.alice.logout()
+        self.alice.login()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_lazy(self):
+        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+
+        self.alice.login()
+        self.alice.trust()
+
+        response = self.alice.get_plain()
+        self.assertNotIn(cookie_name, response.cookies)
+
+        response = self.alice.get_restricted()
+        self.assertIn(cookie_name, response.cookies)
+
+    def test_refresh(self):
+        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+
+        with settings(AGENT_COOKIE_REFRESH_FRACTION=0.1):
+            self.alice.login()
+            self.alice.trust()
+            response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(cookie_name, response.cookies)
+
+    def test_refresh_revoke_others(self):
+        alice1 = AgentClient('alice')
+        alice2 = AgentClient('alice')
+
+        with settings(AGENT_COOKIE_REFRESH_FRACTION=0.1):
+            alice1.login()
+            alice1.trust()
+
+            alice2.login()
+            alice2.trust()
+            alice2.revoke_others()
+
+            response1 = alice1.get_restricted()
+            response2 = alice2.get_restricted()
+
+        self.assertEqual(response1.status_code, 302)
+        self.assertEqual(response2.status_code, 200)
+
+    def test_compact_session(self):
+        with settings(AGENT_COOKIE_FORMAT='compact'):
+            self.alice.login()
+            self.alice.trust_session()
+            response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_exempt_path(self):
+        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+
+        self.alice.login()
+        self.alice.trust()
+
+        with settings(AGENT_EXEMPT_PATHS=[r'^restricted/']):
+            alice = AgentClient('alice')
+            alice.cookies = self.alice.cookies
+            response = alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(cookie_name, response.cookies)
+
+    def test_exempt_view(self):
+        cookie_name = AgentMiddleware._cookie_name(self.alice.username)
+
+        self.alice.login()
+        self.alice.trust()
+
+        with self.assertNumQueries(0):
+            response = self.alice.get('/exempt/')
+
+        self.assertEqual(response.content, b'False')
+        self.assertNotIn(cookie_name, response.cookies)
+
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_lazy_queries(self):
+        self.alice.login()
+        self.alice.get_plain()
+
+        with self.assertNumQueries(0):
+            self.alice.get_plain()
+
+    def test_trusted_session(self):
+        self.alice.login()
+        self.alice.trust_session()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_old_session(self):
+        self.alice.login()
+        self.alice.trust_session()
+        self.alice.logout()
+        self.alice.login()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_anon_session(self):
+        self.alice.trust_session()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_replace_trust(self):
+        self.alice.login()
+        self.alice.trust()
+        self.alice.trust_session()
+        self.alice.logout()
+        self.alice.login()
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_other_trusted(self):
+        self.alice.login()
+        self.alice.trust()
+        self.alice.logout()
+
+        self.bob.login()
+        response = self.bob.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_other_revoked(self):
+        self.alice.login()
+        self.alice.trust()
+
+        self.bob.login()
+        self.bob.trust()
+        self.bob.revoke()
+        self.bob.logout()
+
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_revoke_others(self):
+        alice1 = AgentClient('alice')
+        alice2 = AgentClient('alice')
+
+        alice1.login()
+        alice1.trust()
+
+        alice2.login()
+        alice2.trust()
+        alice2.revoke_others()
+
+        response = alice1.get_restricted()
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_revoke_others_cached(self):
+        alice1 = AgentClient('alice')
+        alice2 = AgentClient('alice')
+
+        with settings(AGENT_SETTINGS_CACHE='default'):
+            alice1.login()
+            alice1.trust()
+
+            alice2.login()
+            alice2.trust()
+            alice2.revoke_others()
+
+            response1 = alice1.get_restricted()
+            response2 = alice2.get_restricted()
+
+        self.assertEqual(response1.status_code, 302)
+        self.assertEqual(response2.status_code, 200)
+
+
+class TimingTestCase(AgentTrustTestCase):
+    """
+    Per-phase timings of the middleware.
+    """
+    def setUp(self):
+        try:
+            self.create_user('alice', 'alice')
+        except IntegrityError:
+            self.skipTest("Unable to create a test user.")
+
+        self.alice = AgentClient('alice')
+        self.alice.login()
+        self.alice.trust()
+
+        self.received = []
+        agent_timing.connect(self._receiver)
+
+    def tearDown(self):
+        agent_timing.disconnect(self._receiver)
+
+    def _receiver(self, sender, request, timings, **kwargs):
+        self.received.append(timings)
+
+    def test_disabled(self):
+        response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.received, [])
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_signal(self):
+        with settings(AGENT_TIMING=True):
+            response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.received), 1)
+        self.assertTrue({'settings', 'verify', 'decode', 'save'} <= set(self.received[0]))
+        self.assertTrue(set(self.received[0]) <= set(timing.PHASES))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_server_timing(self):
+        with settings(AGENT_SERVER_TIMING=True):
+            response = self.alice.get_restricted()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.received), 1)
+        self.assertIn('agent-verify;dur=', response['Server-Timing'])
+
+    def test_phase_disabled(self):
+        self.assertIs(timing.phase('verify'), timing.phase('decode'))
+
+    def test_phase(self):
+        timings, token = timing.start()
+        try:
+            with timing.phase('verify'):
+                pass
+            with timing.phase('verify'):
+                pass
+        finally:
+            timing.stop(token)
+
+        self.assertEqual(list(timings.phases), ['verify'])
+        self.assertRegex(timings.server_timing(), r'^agent-verify;dur=\d+\.\d{3}$')
+        self.assertIsNone(timing._current.get())
+
+
+class StatsTestCase(AgentTrustTestCase):
+    """
+    Counters of outcomes and discard reasons.
+    """
+    def setUp(self):
+        try:
+            self.alice = self.create_user('alice', 'alice')
+        except IntegrityError:
+            self.skipTest("Unable to create a test user.")
+
+        self.client = AgentClient('alice')
+        self.client.login()
+
+        stats.reset()
+
+    def tearDown(self):
+        stats.reset()
+
+    def test_trusted(self):
+        self.client.trust()
+        self.client.get_restricted()
+
+        self.assertEqual(stats.outcomes.snapshot(), {'trusted': 1, 'untrusted': 0})
+        self.assertEqual(sum(stats.discards.snapshot().values()), 0)
+
+    def test_no_cookie(self):
+        self.client.get_restricted()
+
+        self.assertEqual(sum(stats.outcomes.snapshot().values()), 0)
+
+    def test_bad_signature(self):
+        self.client.trust()
+        self._tamper()
+        self.client.get_restricted()
+
+        self.assertEqual(stats.outcomes.snapshot()['untrusted'], 1)
+        self.assertEqual(stats.discards.snapshot()['bad_signature'], 1)
+
+    def test_serial(self):
+        self.client.trust()
+        self._revoke()
+        self.client.get_restricted()
+
+        self.assertEqual(stats.outcomes.snapshot()['untrusted'], 1)
+        self.assertEqual(stats.discards.snapshot()['serial'], 1)
+
+    def test_session(self):
+        self.client.trust_session()
+        self.client.logout()
+        self.client.login()
+        self.client.get_restricted()
+
+        self.assertEqual(stats.discards.snapshot()['session'], 1)
+
+    def test_username(self):
+        bob = self.create_user('bob', 'bob')
+        middleware = AgentMiddleware()
+        encoded = middleware._encode_cookie(Agent.trusted_agent(self.alice), self.alice)
+
+        # Alice's payload, signed for Bob's cookie.
+        cookie_name = AgentMiddleware._cookie_name('bob')
+        request = RequestFactory().get('/')
+        request.user = bob
+        request.COOKIES[cookie_name] = signing.get_cookie_signer(
+            salt=cookie_name
+        ).sign(encoded)
+
+        agent = middleware._get_agent(request)
+
+        self.assertTrue(not agent.is_trusted)
+        self.assertEqual(stats.discards.snapshot()['username'], 1)
+
+    def test_callback(self):
+        names = []
+
+        with settings(AGENT_STATS_CALLBACK=names.append):
+            self.client.trust()
+            self._revoke()
+            self.client.get_restricted()
+
+        self.assertEqual(names, ['discard.serial', 'outcome.untrusted'])
+
+    def test_callback_path(self):
+        with settings(AGENT_STATS_CALLBACK='test_project.tests.record_stat'):
+            self.client.trust()
+            self.client.get_restricted()
+
+        self.assertIn('outcome.trusted', recorded_stats)
+
+    def test_bad_callback(self):
+        with self.assertRaises(ImproperlyConfigured):
+            with settings(AGENT_STATS_CALLBACK=1):
+                pass
+
+    def test_prometheus(self):
+        self.client.trust()
+        self.client.get_restricted()
+
+        response = metrics(RequestFactory().get('/metrics/'))
+        text = response.content.decode()
+
+        self.assertEqual(response['Content-Type'], stats.PROMETHEUS_CONTENT_TYPE)
+        self.assertIn('# TYPE django_agent_trust_outcomes_total counter', text)
+        self.assertIn('django_agent_trust_outcomes_total{outcome="trusted"} 1', text)
+        self.assertIn('django_agent_trust_discards_total{reason="serial"} 0', text)
+
+    def _tamper(self):
+        cookie_name = AgentMiddleware._cookie_name('alice')
+        self.client.cookies[cookie_name] = self.client.cookies[cookie_name].value + 'x'
+
+    def _revoke(self):
+        agentsettings = AgentSettings.objects.get(user=self.alice)
+        agentsettings.serial += 1
+        agentsettings.save()
+
+
+recorded_stats = []
+
+
+def record_stat(name):
+    recorded_stats.append(name)
+
+
+class LoggingTestCase(AgentTrustTestCase):
+    """
+    Structured debug records.
+    """
+    logger_name = 'django_agent_trust.middleware'
+
+    def setUp(self):
+        self.alice = self.create_user('alice', 'alice')
+        self.middleware = AgentMiddleware()
+
+    def test_load(self):
+        with self.assertLogs(self.logger_name, 'DEBUG') as logs:
+            self._load(Agent.trusted_agent(self.alice))
+
+        self.assertEqual(len(logs.records), 1)
+        fields = logs.records[0].agent_trust
+        self.assertEqual(fields['event'], 'load')
+        self.assertEqual(fields['outcome'], 'trusted')
+        self.assertEqual(fields['username_hash'], codec.username_digest('alice').hex())
+        self.assertEqual(fields['serial'], 0)
+        self.assertIsNone(fields['reason'])
+        self.assertNotIn('alice', logs.output[0])
+
+    def test_discarded(self):
+        agent = Agent.trusted_agent(self.alice)
+        self.alice.agentsettings.serial += 1
+        self.alice.agentsettings.save()
+
+        fields = self._load_fields(agent)
+
+        self.assertEqual(fields['outcome'], 'discarded')
+        self.assertEqual(fields['reason'], 'serial')
+
+    def test_session_mismatch(self):
+        agent = Agent.trusted_agent(self.alice)._replace(session=1234)
+
+        fields = self._load_fields(agent, session={SESSION_TOKEN_KEY: 5678})
+
+        self.assertEqual(fields['outcome'], 'discarded')
+        self.assertEqual(fields['reason'], 'session')
+        self.assertIsNone(fields['serial'])
+
+    def test_expired(self):
+        agent = Agent(self.alice, True, now() - timedelta(days=3), 2, 0, None)
+
+        fields = self._load_fields(agent)
+
+        self.assertEqual(fields['outcome'], 'discarded')
+        self.assertEqual(fields['reason'], 'expired')
+
+    def test_bad_signature(self):
+        fields = self._load_fields(Agent.trusted_agent(self.alice), tamper=True)
+
+        self.assertEqual(fields['outcome'], 'discarded')
+        self.assertEqual(fields['reason'], 'bad_signature')
+
+    def test_save(self):
+        client = AgentClient('alice')
+        client.login()
+
+        with self.assertLogs(self.logger_name, 'DEBUG') as logs:
+            client.trust()
+
+        events = [record.agent_trust['event'] for record in logs.records]
+        self.assertIn('save', events)
+
+    def test_disabled(self):
+        with patch('django_agent_trust.middleware._log_agent') as log_agent:
+            self._load(Agent.trusted_agent(self.alice))
+
+        log_agent.assert_not_called()
+
+    def test_sample_rate(self):
+        agent = Agent.trusted_agent(self.alice)
+
+        with settings(AGENT_LOG_SAMPLE_RATE=0):
+            with self.assertNoLogs(self.logger_name, 'DEBUG'):
+                self._load(agent)
+
+    def _load_fields(self, agent, **kwargs):
+        with self.assertLogs(self.logger_name, 'DEBUG') as logs:
+            self._load(agent, **kwargs)
+
+        self.assertEqual(len(logs.records), 1)
+
+        return logs.records[0].agent_trust
+
+    def _load(self, agent, session=None, tamper=False):
+        cookie_name = AgentMiddleware._cookie_name('alice')
+        signed = signing.get_cookie_signer(salt=cookie_name).sign(
+            self.middleware._encode_cookie(agent, self.alice)
+        )
+
+        request = RequestFactory().get('/')
+        request.user = get_user_model().objects.get(pk=self.alice.pk)
+        request.session = session if (session is not None) else {}
+        request.COOKIES[cookie_name] = signed + ('x' if tamper else '')
+
+        return self.middleware._get_agent(request)
+
+    def test_bad_sample_rate(self):
+        with self.assertRaises(ImproperlyConfigured):
+            with settings(AGENT_LOG_SAMPLE_RATE=1.5):
+                pass
+
+
+class ConsolidatedCookieTestCase(AgentTrustTestCase):
+    """
+    Several users sharing one browser with a consolidated cookie.
+    """
+    def setUp(self):
+        for username in ['alice', 'bob', 'charlie']:
+            self.create_user(username, username)
+
+        self.browser = AgentClient('alice')
+
+        self.consolidated = settings(AGENT_COOKIE_MODE='consolidated')
+        self.consolidated.__enter__()
+
+    def tearDown(self):
+        self.consolidated.__exit__(None, None, None)
+
+    def test_shared(self):
+        self._trust('alice')
+        self._trust('bob')
+
+        self.assertEqual(self._entry_count(), 2)
+        self.assertEqual(self._legacy_cookies(), [])
+        self.assertEqual(self._login('alice').get_restricted().status_code, 200)
+
+    def test_max_users(self):
+        with settings(AGENT_COOKIE_MAX_USERS=2):
+            self._trust('alice')
+            self._trust('bob')
+            self._trust('charlie')
+
+            self.assertEqual(self._entry_count(), 2)
+            self.assertEqual(self._login('alice').get_restricted().status_code, 302)
+            self.assertEqual(self._login('bob').get_restricted().status_code, 200)
+
+    def test_lru(self):
+        with settings(AGENT_COOKIE_MAX_USERS=2):
+            self._trust('alice')
+            self._trust('bob')
+            self._login('alice').get_restricted()
+            self._trust('charlie')
+
+            self.assertEqual(self._login('alice').get_restricted().status_code, 200)
+            self.assertEqual(self._login('bob').get_restricted().status_code, 302)
+
+    def test_revoke(self):
+        self._trust('alice')
+        self._trust('bob').revoke()
+
+        self.assertEqual(self._entry_count(), 1)
+        self.assertEqual(self._login('alice').get_restricted().status_code, 200)
+
+    def test_legacy(self):
+        with settings(AGENT_COOKIE_MODE='per-user'):
+            self._trust('alice')
+
+        self.assertEqual(len(self._legacy_cookies()), 1)
+        self.assertEqual(self.browser.get_restricted().status_code, 200)
+        self.assertEqual(self._legacy_cookies(), [])
+        self.assertEqual(self._entry_count(), 1)
+
+    def test_prune_stale(self):
+        self._trust('alice')
+        self.browser.cookies[settings.AGENT_COOKIE_NAME] = '{0}|{1}!x:1:sig'.format(
+            self.browser.cookies[settings.AGENT_COOKIE_NAME].value, '0' * 16
+        )
+        self.assertEqual(self._entry_count(), 2)
+
+        # Bob has no trust, so only the pruning is written.
+        self._login('bob').get_restricted()
+
+        self.assertEqual(self._entry_count(), 1)
+        self.assertEqual(self._login('alice').get_restricted().status_code, 200)
+
+    def test_prune_anonymous(self):
+        with settings(AGENT_COOKIE_MODE='per-user'):
+            self._trust('alice')
+        self.browser.logout()
+
+        self.assertEqual(len(self._legacy_cookies()), 1)
+        self.assertEqual(self.browser.get_restricted().status_code, 302)
+        self.assertEqual(self._legacy_cookies(), [])
+
+    def _login(self, username):
+        self.browser.username = self.browser.password = username
+        self.browser.login()
+
+        return self.browser
+
+    def _trust(self, username):
+        self._login(username).trust()
+
+        return self.browser
+
+    def _entry_count(self):
+        value = self.browser.cookies[settings.AGENT_COOKIE_NAME].value
+
+        return len(value.split('|')) if value else 0
+
+    def _legacy_cookies(self):
+        prefix = settings.AGENT_COOKIE_NAME + '-'
+
+        return [
+            name
+            for name, morsel in self.browser.cookies.items()
+            if name.startswith(prefix) and morsel.value
+        ]
+
+
+class AsyncHttpTestCase(AgentTrustTestCase):
+    """
+    Exercises the middleware's async path.
+    """
+    def setUp(self):
+        try:
+            self.create_user('alice', 'alice')
+        except IntegrityError:
+            self.skipTest("Unable to create a test user.")
+
+        self.client = AsyncClient()
+
+    async def test_anonymous(self):
+        response = await self.client.get('/restricted/')
+
+        self.assertEqual(response.status_code, 302)
+
+    async def test_trusted(self):
+        await self._login()
+        await self.client.post('/trust/')
+        response = await self.client.get('/restricted/')
+
+        self.assertEqual(response.status_code, 200)
+
+    async def test_trusted_session(self):
+        await self._login()
+        await self.client.post('/session/')
+        response = await self.client.get('/restricted/')
+
+        self.assertEqual(response.status_code, 200)
+
+    async def test_old_session(self):
+        await self._login()
+        await self.client.post('/session/')
+        await self.client.post('/logout/')
+        await self._login()
+        response = await self.client.get('/restricted/')
+
+        self.assertEqual(response.status_code, 302)
+
+    async def test_async_view(self):
+        async def view(request):
+            return HttpResponse(str(request.agent.is_trusted))
+
+        request, response = await self._call_view(view)
+
+        self.assertIs(type(request.agent), Agent)
+        self.assertEqual(response.content, b'False')
+
+    async def test_exempt_view(self):
+        @agent_trust_exempt
+        async def view(request):
+            return HttpResponse(str(request.agent.is_trusted))
+
+        request, response = await self._call_view(view)
+
+        self.assertIs(request.agent, EXEMPT_AGENT)
+        self.assertEqual(response.content, b'False')
+
+    async def test_no_cookie(self):
+        user = await get_user_model().objects.aget(username='alice')
+        await AgentSettings.objects.filter(user=user).adelete()
+
+        async def view(request):
+            return HttpResponse(str(request.agent.is_trusted))
+
+        request, response = await self._call_view(view, user)
+
+        self.assertEqual(response.content, b'False')
+        # Nothing to verify, so nothing was loaded or created.
+        self.assertFalse(await AgentSettings.objects.filter(user=user).aexists())
+
+    async def test_sync_view_lazy(self):
+        def view(request):
+            return HttpResponse()
+
+        request, response = await self._call_view(view)
+
+        self.assertTrue(AgentMiddleware()._is_pending(request))
+
+    async def test_trusted_epoch(self):
+        await self._login()
+        await self.client.post('/trust/')
+
+        # The async path must not read the epoch synchronously.
+        with settings(AGENT_EPOCH_CACHE='default'):
+            with patch(
+                'django_agent_trust.middleware.current_epoch', side_effect=AssertionError
+            ):
+                response = await self.client.get('/async-restricted/')
+
+        self.assertEqual(response.status_code, 200)
+
+    async def test_acurrent_epoch(self):
+        revocation.reset()
+        await caches['default'].aset(revocation.EPOCH_KEY, 3, timeout=None)
+
+        try:
+            with settings(AGENT_EPOCH_CACHE='default'):
+                epoch = await revocation.acurrent_epoch()
+        finally:
+            await caches['default'].adelete(revocation.EPOCH_KEY)
+            revocation.reset()
+
+        self.assertEqual(epoch, 3)
+
+    async def _call_view(self, view, user=None):
+        """
+        Runs a view through the middleware, including process_view.
+        """
+        async def get_response(request):
+            await middleware.process_view(request, view, (), {})
+
+            if iscoroutinefunction(view):
+                return await view(request)
+
+            return view(request)
+
+        middleware = AgentMiddleware(get_response)
+        request = AsyncRequestFactory().get('/')
+        request.user = user if (user is not None) else AnonymousUser()
+        response = await middleware(request)
+
+        return request, response
+
+    async def _login(self):
+        return await self.client.post(
+            '/login/', {'username': 'alice', 'password': 'alice'}
+        )
 
 
 class AgentClient(Client):
@@ -412,6 +1987,9 @@ class AgentClient(Client):
     def logout(self):
         return self.post('/logout/')
 
+    def get_plain(self):
+        return self.get('/plain/')
+
     def get_restricted(self):
         return self.get('/restricted/')
 
@@ -9,7 +9,11 @@ urlpatterns = [
     path('login/', django.contrib.auth.views.LoginView.as_view()),
     path('logout/', django.contrib.auth.views.LogoutView.as_view()),
 
+    path('exempt/', views.ExemptView.as_view()),
+    path('plain/', views.PlainView.as_view()),
     path('restricted/', views.RestrictedView.as_view()),
+    path('async-restricted/', views.async_restricted_view),
+    path('async-mixin/', views.AsyncRestrictedView.as_view()),
     path('trust/', views.TrustView.as_view()),
     path('session/', views.SessionView.as_view()),
     path('revoke/', views.RevokeView.as_view()),
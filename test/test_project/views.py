@@ -3,7 +3,22 @@ from django.utils.decorators import method_decorator
 from django.views.generic.base import View
 
 from django_agent_trust import revoke_agent, revoke_other_agents, trust_agent, trust_session
-from django_agent_trust.decorators import trusted_agent_required
+from django_agent_trust.decorators import (
+    TrustedAgentRequiredMixin,
+    agent_trust_exempt,
+    trusted_agent_required,
+)
+
+
+class PlainView(View):
+    def get(self, request):
+        return HttpResponse()
+
+
+@method_decorator(agent_trust_exempt, name='dispatch')
+class ExemptView(View):
+    def get(self, request):
+        return HttpResponse(str(request.agent.is_trusted))
 
 
 class RestrictedView(View):
@@ -12,6 +27,16 @@ class RestrictedView(View):
         return HttpResponse()
 
 
+@trusted_agent_required
+async def async_restricted_view(request):
+    return HttpResponse()
+
+
+class AsyncRestrictedView(TrustedAgentRequiredMixin, View):
+    async def get(self, request):
+        return HttpResponse()
+
+
 class TrustView(View):
     def post(self, request):
         trust_agent(request)